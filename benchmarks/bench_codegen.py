@@ -0,0 +1,35 @@
+"""
+    Tree interpreter against generated Python code
+
+    python -m benchmarks.bench_codegen
+"""
+
+import timeit
+
+from xpath_validator import compile
+
+CASES = [
+    (". >= ${min} and . <= ${max}", 50, {"min": 10, "max": 100}),
+    ("(. mod 2) = 0 and . * 5 > 10", 10, {}),
+    ("string-length(.) = 11 and starts-with(., 'ab')", "abacate1234", {}),
+    ("choose(. > 1, . div 2, . * 3) < 100", 42, {}),
+    ("not(number(.) != number(.)) and int(.) >= 0", "17", {}),
+]
+
+
+def bench(number=100000):
+    for expression, value, context in CASES:
+        timings = {}
+        for backend in ("interpreter", "python"):
+            exp = compile(expression, backend=backend)
+            timings[backend] = min(timeit.repeat(
+                lambda: exp.evaluate(value, context), number=number, repeat=3
+            ))
+        print("%-55s interpreter %6.3fs  python %6.3fs  x%.1f" % (
+            expression, timings["interpreter"], timings["python"],
+            timings["interpreter"] / timings["python"],
+        ))
+
+
+if __name__ == "__main__":
+    bench()
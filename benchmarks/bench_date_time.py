@@ -0,0 +1,47 @@
+"""
+    format-date-time: strptime loop against shape dispatch and the parse cache
+
+    python -m benchmarks.bench_date_time
+"""
+
+import datetime
+import timeit
+
+from xpath_validator import DATE_TIME_CACHE, DATE_TIME_FORMATS, _format_date_time
+
+SAMPLES = [
+    "2019-05-14T19:13:35.450686Z",
+    "2019-05-14 19:13:35",
+    "2019-05-14",
+    "14/05/2019 19:13",
+    "14/05/19",
+    "19:13:35",
+    "not a date",
+]
+
+
+def _loop(sdt, format):
+    for f in DATE_TIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(sdt, f).strftime(format)
+        except Exception:
+            pass
+    return None
+
+
+def _uncached(sdt, format):
+    DATE_TIME_CACHE.clear()
+    return _format_date_time(sdt, format)
+
+
+def bench(number=20000):
+    for sdt in SAMPLES:
+        timings = [
+            min(timeit.repeat(lambda: f(sdt, "%Y"), number=number, repeat=3))
+            for f in (_loop, _uncached, _format_date_time)
+        ]
+        print("%-30s loop %6.3fs  dispatch %6.3fs  cached %6.3fs" % ((repr(sdt),) + tuple(timings)))
+
+
+if __name__ == "__main__":
+    bench()
@@ -0,0 +1,51 @@
+"""
+    Memory held per compiled expression
+
+    python -m benchmarks.bench_memory
+
+    "token dicts" is the tree of the old parse(), kept in
+    benchmarks.legacy_parse, next to the __slots__ tree of parse() and the
+    compiled expression
+"""
+
+import gc
+import tracemalloc
+
+from benchmarks import legacy_parse
+from xpath_validator import compile
+from xpath_validator.xp_parse import parse
+from xpath_validator.xp_tokenize import tokenize
+
+TEMPLATES = [
+    ". >= %d and . <= %d",
+    "string-length(.) = %d or starts-with(., 'p%d')",
+    "int(format-date-time(., '%%Y')) >= %d and ${min%d} < .",
+    "choose(. > %d, . div 2, . * %d) != 0",
+]
+
+
+def _expressions(n):
+    return [t % (i, i) for i in range(n) for t in TEMPLATES]
+
+
+def measure(build, expressions):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = [build(e) for e in expressions]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return (after - before) / float(len(expressions))
+
+
+def bench(n=2500):
+    expressions = _expressions(n)
+    print("%d expressions" % len(expressions))
+    print("token dicts      %8.0f bytes/expression" % measure(lambda e: legacy_parse.parse(e, tokenize(e)), expressions))
+    print("parse() tree     %8.0f bytes/expression" % measure(lambda e: parse(e, tokenize(e)), expressions))
+    print("compiled         %8.0f bytes/expression" % measure(compile, expressions))
+
+
+if __name__ == "__main__":
+    bench()
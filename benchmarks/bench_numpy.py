@@ -0,0 +1,36 @@
+"""
+    Column-wise checks: item by item against the vectorized path
+
+    python -m benchmarks.bench_numpy
+"""
+
+import time
+
+import numpy as np
+
+from xpath_validator import compile
+from xpath_validator.xp_numpy import evaluate_array
+
+CASES = [
+    (". >= ${min} and . <= ${max}", {"min": 10, "max": 900}),
+    ("(. mod 2) = 0 or floor(. div 7) = 3", {}),
+]
+
+
+def bench(n=1000000):
+    values = np.random.RandomState(0).randint(0, 1000, size=n)
+    items = values.tolist()
+    for expression, context in CASES:
+        exp = compile(expression)
+        start = time.perf_counter()
+        expected = list(exp.evaluate_many(items, context))
+        loop = time.perf_counter() - start
+        start = time.perf_counter()
+        mask = evaluate_array(exp, values, context)
+        vector = time.perf_counter() - start
+        assert mask.tolist() == expected
+        print("%-40s %d rows  loop %6.3fs  numpy %6.3fs  x%.0f" % (expression, n, loop, vector, loop / vector))
+
+
+if __name__ == "__main__":
+    bench()
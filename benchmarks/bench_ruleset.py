@@ -0,0 +1,61 @@
+"""
+    Matching values against thousands of range/equality/prefix rules: one
+    validate() per rule against RuleSet.match()
+
+    python -m benchmarks.bench_ruleset
+"""
+
+import random
+import time
+
+from xpath_validator import compile
+from xpath_validator.xp_ruleset import RuleSet
+
+
+def make_rules(n):
+    rnd = random.Random(0)
+    rules = {}
+    for i in range(n):
+        kind = i % 3
+        if kind == 0:
+            lo = rnd.randint(0, 10000)
+            rules["range%d" % i] = ". >= %d and . < %d" % (lo, lo + rnd.randint(1, 50))
+        elif kind == 1:
+            rules["eq%d" % i] = ". = 'sku-%d'" % rnd.randint(0, 5000)
+        else:
+            rules["prefix%d" % i] = "starts-with(., 'r%d-')" % rnd.randint(0, 500)
+    return rules
+
+
+def bench(n=3000, lookups=200):
+    rules = make_rules(n)
+    rnd = random.Random(1)
+    values = [rnd.choice([rnd.randint(0, 10000), "sku-%d" % rnd.randint(0, 5000), "r%d-x" % rnd.randint(0, 500)]) for _ in range(lookups)]
+
+    compiled = [(name, compile(expression)) for name, expression in rules.items()]
+    start = time.perf_counter()
+    expected = []
+    for value in values:
+        found = []
+        for name, exp in compiled:
+            try:
+                if exp.evaluate(value):
+                    found.append(name)
+            except Exception:
+                pass
+        expected.append(found)
+    loop = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ruleset = RuleSet(rules)
+    build = time.perf_counter() - start
+    start = time.perf_counter()
+    found = [ruleset.match(value) for value in values]
+    indexed = time.perf_counter() - start
+    assert found == expected
+    print("%d rules, %d lookups  loop %6.3fs  RuleSet %6.4fs (+%.3fs build)  x%.0f" % (
+        n, lookups, loop, indexed, build, loop / indexed))
+
+
+if __name__ == "__main__":
+    bench()
@@ -0,0 +1,46 @@
+"""
+    Worker startup: compiling a rule catalog against loading it from a store
+    file
+
+    python -m benchmarks.bench_store
+"""
+
+import os
+import tempfile
+import time
+
+from xpath_validator import compile
+from xpath_validator.xp_store import RuleStore, write_store
+
+
+def make_catalog(n):
+    return [
+        "(. >= %d and . <= %d) or (string-length(string(.)) = %d and not(contains(., '%d')))" % (i, i * 3, i % 11, i)
+        for i in range(n)
+    ]
+
+
+def bench(n=20000):
+    catalog = make_catalog(n)
+    path = os.path.join(tempfile.mkdtemp(), "rules.xpc")
+    start = time.perf_counter()
+    write_store(path, catalog)
+    build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    compiled = [compile(expression) for expression in catalog]
+    parse = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with RuleStore(path) as store:
+        opened = time.perf_counter() - start
+        loaded = [store.compile(expression) for expression in catalog]
+    load = time.perf_counter() - start
+    assert [str(exp) for exp in loaded] == [str(exp) for exp in compiled]
+    print("%d expressions, %d bytes  compile %6.3fs  store open %6.5fs  open+load all %6.3fs  (build %6.3fs)" % (
+        n, os.path.getsize(path), parse, opened, load, build))
+    os.remove(path)
+
+
+if __name__ == "__main__":
+    bench()
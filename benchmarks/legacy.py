@@ -0,0 +1,174 @@
+"""
+    Frozen copy of the Lisp round trip validate() used before compile(),
+    kept only for the legacy timings of benchmarks.suite: the expression is
+    parsed, written back as a Lisp program, split into atoms again and
+    evaluated through ENV
+"""
+
+from xpath_validator import ENV as _OPERATORS
+from xpath_validator import FUNCTIONS, XPathStr
+from xpath_validator.xp_parse import BinOp, Call, Dot, Name, parse
+from xpath_validator.xp_tokenize import tokenize
+
+ENV = dict(_OPERATORS)
+ENV["$"] = lambda f, *args: FUNCTIONS[f](*args)
+
+
+class Symbol(str):
+    pass
+
+
+class Function(str):
+    pass
+
+
+def _lsp_atom(token):
+    '''
+    >>> type(_lsp_atom('$'))
+    <class 'benchmarks.legacy.Symbol'>
+    >>> type(_lsp_atom('boolean'))
+    <class 'benchmarks.legacy.Function'>
+    >>> type(_lsp_atom('selected'))
+    <class 'benchmarks.legacy.Function'>
+    >>> type(_lsp_atom('peixe abacate'))
+    <class 'xpath_validator.XPathStr'>
+    >>> type(_lsp_atom('5')) == float
+    True
+    '''
+    try:
+        return float(token)
+    except ValueError:
+        if token in FUNCTIONS.keys():
+            return Function(token)
+        if token in ENV.keys():
+            return Symbol(token)
+        return XPathStr(token)
+
+
+def _lsp_atomize(tokens):
+    '''
+    >>> _lsp_atomize(['(', '$', 'boolean', '(', '$', 'selected', 'peixe abacate', '.', ')', ')'])
+    ['$', 'boolean', ['$', 'selected', 'peixe abacate', '.']]
+    '''
+    if len(tokens) == 0:
+        raise SyntaxError("unexpected EOF")
+    token = tokens.pop(0)
+    if token == "(":
+        r = []
+        while tokens[0] != ")":
+            r.append(_lsp_atomize(tokens))
+        tokens.pop(0)
+        return r
+    elif token == ")":
+        raise SyntaxError("unexpected )")
+    else:
+        return _lsp_atom(token)
+
+
+def _lsp_split_atomize(program):
+    '''
+    _lsp_split_atomize(' ( $ boolean  ( $ selected "peixe abacate" . )  ) ')
+    ['(', '$', 'boolean', '(', '$', 'selected', 'peixe abacate', '.', ')', ')']
+    '''
+    string_delimiter = ''
+    atoms = []
+    atom = ''
+    program = program.replace(")", " ) ").replace("(", " ( ")
+    pl = len(program)
+    i = 0
+    while i < pl:
+        c = program[i]
+        if c not in ['"', "'"]:
+            if c == ' ':
+                atom_striped = atom.strip()
+                if atom_striped:
+                    atoms.append(atom_striped)
+                atom = ''
+            atom += c
+        else:
+            string_delimiter = c
+            i += 1
+            c = program[i]
+            atom += c
+            while c != string_delimiter:
+                i += 1
+                c = program[i]
+                if c not in ['"', "'"]:
+                    atom += c
+            i += 1
+            atom_striped = atom.strip()
+            if atom_striped:
+                atoms.append(atom_striped)
+            atom = ''
+        i += 1
+    return atoms
+
+
+def _lsp_parse(program, data_node=""):
+    '''
+    >>> _lsp_parse('($ boolean ($ selected "peixe abacate" .))', data_node="peixe")
+    ['$', 'boolean', ['$', 'selected', 'peixe abacate', 'peixe']]
+    '''
+    a = _lsp_atomize(_lsp_split_atomize(program))
+    if isinstance(data_node, str):
+        data_node = XPathStr(data_node)
+
+    def replace_dot(atoms):
+        for i, e in enumerate(atoms):
+            if isinstance(e, list):
+                atoms[i] = replace_dot(e)
+            elif e == ".":
+                atoms[i] = data_node
+        return atoms
+
+    return replace_dot(a)
+
+
+def _lisp(t):
+    if isinstance(t, BinOp):
+        return "(%s %s %s)" % (t.op, _lisp(t.left), _lisp(t.right))
+    if isinstance(t, Call):
+        args = "".join([" " + _lisp(tt) for tt in t.args])
+        return "($ " + t.name + args + ")"
+    if isinstance(t, Dot):
+        return "."
+    if isinstance(t, Name):
+        return t.name
+
+    if t.value == "":
+        return "''"
+
+    if isinstance(t.value, str):
+        if '"' in t.value:
+            return "'%s'" % t.value
+        else:
+            return '"%s"' % t.value
+
+    return repr(t.value)
+
+
+def _to_lsp(code, returns_bool):
+    '''
+    >>> _to_lsp("boolean(selected('peixe abacate', .))", True)
+    '($ boolean ($ selected "peixe abacate" .))'
+    '''
+    if not code.startswith("boolean") and returns_bool:
+        code = "boolean(%s)" % code
+    tokens = tokenize(code)
+    tree = parse(code, tokens)
+    return _lisp(tree)
+
+
+def _xpath_boolean(x):
+    '''
+    >>> _xpath_boolean([Symbol('$'), Function('boolean'), [Symbol('$'), Function('selected'), XPathStr('peixe abacate'), XPathStr('peixe')]])
+    True
+    >>> _xpath_boolean([Symbol('$'), Function('boolean'), [Symbol('$'), Function('selected'), XPathStr('peixe abacate'), XPathStr('ola')]])
+    False
+    '''
+    if isinstance(x, Symbol):
+        return ENV[x]
+    elif not isinstance(x, list):
+        return x
+    else:
+        return _xpath_boolean(x[0])(*[_xpath_boolean(exp) for exp in x[1:]])
@@ -0,0 +1,207 @@
+"""
+    Frozen copy of parse() as it was before it built __slots__ nodes: the
+    tree is made of the token dicts, and do() copies the bp, lbp, nud and led
+    entries of the parser table into every token.  Kept only to measure the
+    memory of the old trees in benchmarks.bench_memory
+
+    >>> from xpath_validator.xp_tokenize import tokenize
+    >>> tree = parse('. > 1', tokenize('. > 1'))
+    >>> tree['val'], sorted(tree)
+    ('>', ['bp', 'from', 'items', 'lbp', 'led', 'type', 'val'])
+"""
+from xpath_validator.xp_tokenize import clean, u_error
+
+
+def mktok(t, typ, val, itms=None):
+    '''
+    >>> t = {'from': (1, 8), 'type': 'symbol', 'val': '(', 'bp': 80, 'lbp': 70, 'led': call_led, 'nud': paren_nud}
+    >>> left = {'from': (1, 1), 'type': 'name', 'val': 'boolean', 'lbp': 0, 'nud': itself}
+    >>> mktok(t, "call", "$", [left]) == {'from': (1, 8), 'type': 'call', 'val': '$', 'items': [{'from': (1, 1), 'type': 'name', 'val': 'boolean', 'lbp': 0, 'nud': itself}]}
+    True
+    '''
+    r = {"from": t["from"], "type": typ, "val": val}
+    if itms is not None:
+        r["items"] = itms
+    return r
+
+
+def check(t, *vs):
+    if vs[0] is None:
+        return True
+    if t["type"] in vs:
+        return True
+    if t["type"] == "symbol" and t["val"] in vs:
+        return True
+    return False
+
+
+def tweak(P, k, v):
+    P.stack.append((k, P.dmap[k]))
+    if v:
+        P.dmap[k] = P.omap[k]
+    else:
+        P.dmap[k] = {"lbp": 0, "nud": itself}
+
+
+def restore(P):
+    k, v = P.stack.pop()
+    P.dmap[k] = v
+
+
+class PData:
+    """all the state of one parse() call, so parsers can run concurrently"""
+
+    def __init__(self, s, tokens):
+        self.s = s
+        self.tokens = tokens
+        self.pos = 0
+        self.token = None
+        self.stack = []
+        self.omap = base_dmap
+        self.dmap = base_dmap.copy()
+
+    def init(self):
+        self.advance()
+
+    def advance(self, val=None):
+        if not check(self.token, val):
+            error(self, "expected " + val, self.token)
+        if self.pos < len(self.tokens):
+            t = self.tokens[self.pos]
+            self.pos += 1
+        else:
+            t = {"from": (0, 0), "type": "eof", "val": "eof"}
+        self.token = do(self, t)
+        return t
+
+
+def error(P, ctx, t):
+    u_error(ctx, P.s, t["from"])
+
+
+def nud(P, t):
+    if "nud" not in t:
+        error(P, "no nud", t)
+    return t["nud"](P, t)
+
+
+def led(P, t, left):
+    if "led" not in t:
+        error(P, "no led", t)
+    return t["led"](P, t, left)
+
+
+def get_lbp(P, t):
+    if "lbp" not in t:
+        error(P, "no lbp", t)
+    return t["lbp"]
+
+
+def expression(P, rbp):
+    t = P.token
+    advance(P)
+    left = nud(P, t)
+    while rbp < get_lbp(P, P.token):
+        t = P.token
+        advance(P)
+        left = led(P, t, left)
+    return left
+
+
+def infix_led(P, t, left):
+    t["items"] = [left, expression(P, t["bp"])]
+    return t
+
+
+def call_led(P, t, left):
+    r = mktok(t, "call", "$", [left])
+    while not check(P.token, ")"):
+        tweak(P, ",", 0)
+        r["items"].append(expression(P, 0))
+        if P.token["val"] == ",":
+            advance(P, ",")
+        restore(P)
+    advance(P, ")")
+    return r
+
+
+def itself(P, t):
+    return t
+
+
+def paren_nud(P, t):
+    tweak(P, ",", 1)
+    r = expression(P, 0)
+    restore(P)
+    advance(P, ")")
+    return r
+
+
+def advance(P, t=None):
+    return P.advance(t)
+
+
+def vargs_nud(P, t):
+    t["type"] = "var"
+    t["val"] = "."
+    return t
+
+
+base_dmap = {
+    "!=": {"bp": 40, "lbp": 40, "led": infix_led},
+    "(": {"bp": 80, "lbp": 70, "led": call_led, "nud": paren_nud},
+    ")": {"lbp": 0, "nud": itself},
+    "+": {"bp": 50, "lbp": 50, "led": infix_led},
+    ",": {"bp": 20, "lbp": 20},
+    "-": {"bp": 50, "lbp": 50, "led": infix_led},
+    ".": {"nud": vargs_nud},
+    "<": {"bp": 40, "lbp": 40, "led": infix_led},
+    "<=": {"bp": 40, "lbp": 40, "led": infix_led},
+    "=": {"bp": 40, "lbp": 40, "led": infix_led},
+    ">": {"bp": 40, "lbp": 40, "led": infix_led},
+    ">=": {"bp": 40, "lbp": 40, "led": infix_led},
+    "and": {"bp": 31, "lbp": 31, "led": infix_led},
+    "or": {"bp": 30, "lbp": 30, "led": infix_led},
+    "div": {"bp": 60, "lbp": 60, "led": infix_led},
+    "*": {"bp": 60, "lbp": 60, "led": infix_led},
+    "mod": {"bp": 60, "lbp": 60, "led": infix_led},
+    "eof": {"lbp": 0, "type": "eof", "val": "eof"},
+    "name": {"lbp": 0, "nud": itself},
+    "nl": {"lbp": 0, "nud": itself, "val": "nl"},
+    "number": {"lbp": 0, "nud": itself},
+    "string": {"lbp": 0, "nud": itself},
+    "variable": {"lbp": 0, "nud": itself},
+}
+
+
+def gmap(P, t, v):
+    if v not in P.dmap:
+        error(P, 'unknown "%s"' % v, t)
+    return P.dmap[v]
+
+
+def do(P, t):
+    if t["type"] == "symbol":
+        r = gmap(P, t, t["val"])
+    else:
+        r = gmap(P, t, t["type"])
+    for k in r:
+        t[k] = r[k]
+    return t
+
+
+def do_module(P):
+    tok = P.token
+    items = []
+    while not check(P.token, "eof"):
+        items.append(expression(P, 0))
+    if len(items) > 1:
+        return mktok(tok, "statements", ";", items)
+    return items.pop()
+
+
+def parse(s, tokens, wrap=0):
+    s = clean(s)
+    P = PData(s, tokens)
+    P.init()
+    return do_module(P)
@@ -0,0 +1,245 @@
+"""
+    Benchmark suite: every pipeline stage, end-to-end throughput and memory
+    over a corpus of realistic expressions
+
+    python -m benchmarks.suite --output results.json
+    python -m benchmarks.suite --baseline baseline.json      # exit 1 on regressions
+    python -m benchmarks.suite --output baseline.json --quick
+
+    Stages, each timed on its own in microseconds per expression:
+
+    - tokenize, parse and compile (tokenize, parse, resolve the calls and
+      fold constants); link is compile less tokenize and parse
+    - evaluate: CompiledExpression.evaluate() with both backends
+    - legacy: the Lisp pipeline kept for reference in benchmarks.legacy;
+      prepare (variables substituted in the text, what _prepare_expression
+      did before the tokenizer bound them), _to_lsp/_lisp, _lsp_parse and
+      _xpath_boolean
+
+    validate() is measured in calls per second with the expression cache
+    warm and cold, and memory in bytes held per compiled expression.
+"""
+
+import argparse
+import gc
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import xpath_validator
+from benchmarks.legacy import _lsp_parse, _to_lsp, _xpath_boolean
+from xpath_validator import EXPRESSION_CACHE, FUNCTION_REGISTRY, _fold, _link, compile, validate
+from xpath_validator.xp_parse import parse
+from xpath_validator.xp_tokenize import tokenize
+
+DATE = "2019-05-14T19:13:35.450686Z"
+
+CONTEXT = {"min": 10, "max": 100, "sep": "&", "opts": "peixe abacate laranja", "flag": "no", "limit": 42}
+
+
+def _nested(depth):
+    expression = "."
+    for i in range(depth):
+        expression = "choose(%s > %d, (%s) + 1, %d)" % ("." if i % 2 else "(. * 2)", i, expression, i)
+    return expression + " > 0"
+
+
+# category -> [(expression, value)], evaluated with CONTEXT
+CORPUS = {
+    "date": [
+        ("int(format-date-time(., '%Y')) = 2019", DATE),
+        ("format-date-time(., '%d/%m/%Y') = '14/05/2019'", DATE),
+        ("int(format-date-time(., '%H')) >= 8 and int(format-date-time(., '%H')) < 20", DATE),
+        ("${flag} = 'no' or format-date-time(., '%Y') > 2000", "2020-01-01"),
+    ],
+    "string": [
+        ("string-length(.) = 11", "40258997853"),
+        ("contains(., 'cat') and starts-with(., 'aba')", "abacate"),
+        ("substring-before(., '_') = 'abacate'", "abacate_laranja"),
+        ("normalize-space(.) != '' and not(contains(., ' '))", "  peixe "),
+    ],
+    "arithmetic": [
+        ("(. mod 2) = 0 and (. div 5) < 100", 10),
+        ("floor(. * 1.5) + ceiling(. div 3) = 19", 10),
+        ("round(. * 100) div 100 = 3.14", 3.14159),
+        ("5 + 5 * 2 - . = 5", 10),
+    ],
+    "context": [
+        (". >= ${min} and . <= ${max}", 50),
+        ("selected(${opts}, .) or . = ${flag}", "peixe"),
+        ("substring-after(., ${sep}) = 'bb' and string-length(.) < ${limit}", "aa&bb"),
+        ("choose(${flag} = 'no', . > ${min}, . < ${max}) and . != ${limit}", 20),
+    ],
+    "nested": [
+        (_nested(8), 3),
+        (_nested(24), 3),
+        ("not(not(not(not(. > 1 and (. < 10 or (. = 20 and (. != 3 or . = 4)))))))", 5),
+        ("(((((((((. + 1) * 2) - 3) + 4) * 5) - 6) + 7) * 8) - 9) > 0", 2),
+    ],
+}
+
+
+def _substitute(expression, context):
+    for name, value in context.items():
+        expression = expression.replace("${%s}" % name, repr(value))
+    return expression
+
+
+def _legacy(atoms):
+    try:
+        return _xpath_boolean(atoms)
+    except Exception:
+        return None  # variables compared as text
+
+
+def _stages():
+    '''(name, prepare(expression, value), run(prepared)) of each stage'''
+    def prepared_parse(e, v):
+        return (e, tokenize(e))
+
+    def compile_tree(e):
+        return _fold(_link(parse(e, tokenize(e)), FUNCTION_REGISTRY), {})
+
+    def prepared_lisp(e, v):
+        return _to_lsp(_substitute(e, CONTEXT), True)
+
+    return [
+        ("tokenize", lambda e, v: e, tokenize),
+        ("parse", prepared_parse, lambda p: parse(*p)),
+        # linking and folding work in place, so they need a fresh tree
+        ("compile", lambda e, v: e, compile_tree),
+        ("evaluate.interpreter", lambda e, v: (compile(e), v), lambda p: p[0].evaluate(p[1], CONTEXT)),
+        ("evaluate.python", lambda e, v: (compile(e, backend="python"), v), lambda p: p[0].evaluate(p[1], CONTEXT)),
+        ("legacy.prepare", lambda e, v: e, lambda e: _substitute(e, CONTEXT)),
+        ("legacy.to_lsp", lambda e, v: _substitute(e, CONTEXT), lambda e: _to_lsp(e, True)),
+        ("legacy.lsp_parse", lambda e, v: (prepared_lisp(e, v), v), lambda p: _lsp_parse(*p)),
+        ("legacy.xpath_boolean", lambda e, v: _lsp_parse(prepared_lisp(e, v), v), _legacy),
+    ]
+
+
+def _time(run, items, min_time):
+    """best microseconds per item over repeated passes lasting at least min_time"""
+    best = None
+    total = 0.0
+    passes = 0
+    while total < min_time or passes < 3:
+        start = time.perf_counter()
+        for item in items:
+            run(item)
+        elapsed = time.perf_counter() - start
+        total += elapsed
+        passes += 1
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / len(items) * 1e6
+
+
+def _memory(expressions, copies=200):
+    """bytes held per compiled expression"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = [compile(e) for e in expressions for _ in range(copies)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return (after - before) / float(len(expressions) * copies)
+
+
+def _throughput(items, min_time):
+    """validate() calls per second"""
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        for expression, value in items:
+            validate(expression, value, CONTEXT)
+        calls += len(items)
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return calls / elapsed
+
+
+def run(min_time=0.2):
+    results = {}
+
+    def record(name, value, unit, better):
+        results[name] = {"value": round(value, 3), "unit": unit, "better": better}
+
+    for category, items in sorted(CORPUS.items()):
+        for stage, prepare, stage_run in _stages():
+            prepared = [prepare(e, v) for e, v in items]
+            record("%s.%s" % (stage, category), _time(stage_run, prepared, min_time), "us", "lower")
+        link = results["compile.%s" % category]["value"] - (
+            results["tokenize.%s" % category]["value"] + results["parse.%s" % category]["value"]
+        )
+        record("link.%s" % category, max(link, 0.0), "us", "lower")
+        record("memory.%s" % category, _memory([e for e, v in items]), "bytes", "lower")
+        record("validate.warm.%s" % category, _throughput(items, min_time), "calls/s", "higher")
+        maxsize = EXPRESSION_CACHE.maxsize
+        EXPRESSION_CACHE.resize(0)
+        try:
+            record("validate.cold.%s" % category, _throughput(items, min_time), "calls/s", "higher")
+        finally:
+            EXPRESSION_CACHE.resize(maxsize)
+    return {
+        "version": xpath_validator.__version__,
+        "python": platform.python_version(),
+        "results": results,
+    }
+
+
+def compare(current, baseline, tolerance):
+    '''
+    the metrics of current that are worse than baseline by more than
+    tolerance (0.1 is 10%)
+
+    >>> base = {'results': {'a': {'value': 10.0, 'unit': 'us', 'better': 'lower'},
+    ...                     'b': {'value': 100.0, 'unit': 'calls/s', 'better': 'higher'}}}
+    >>> now = {'results': {'a': {'value': 12.0, 'unit': 'us', 'better': 'lower'},
+    ...                    'b': {'value': 95.0, 'unit': 'calls/s', 'better': 'higher'}}}
+    >>> compare(now, base, 0.1)
+    [('a', 10.0, 12.0)]
+    '''
+    regressions = []
+    for name, metric in sorted(current["results"].items()):
+        old = baseline["results"].get(name)
+        if old is None or not old["value"]:
+            continue
+        if metric["better"] == "lower":
+            worse = metric["value"] > old["value"] * (1 + tolerance)
+        else:
+            worse = metric["value"] < old["value"] * (1 - tolerance)
+        if worse:
+            regressions.append((name, old["value"], metric["value"]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.suite", description=__doc__.split("\n")[1].strip())
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results to compare with, regressions fail the run")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown, default 0.25 (25%%)")
+    parser.add_argument("--quick", action="store_true", help="shorter timings, for smoke runs")
+    args = parser.parse_args(argv)
+
+    current = run(min_time=0.02 if args.quick else 0.2)
+    for name, metric in sorted(current["results"].items()):
+        print("%-40s %14.3f %s" % (name, metric["value"], metric["unit"]))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(current, baseline, args.tolerance)
+        for name, old, new in regressions:
+            print("REGRESSION %s: %s -> %s" % (name, old, new))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,13 +10,14 @@ setup(
     author_email='marcelo.tambalo@nectosystems.com.br',
     url='https://github.com/znc-sistemas/xpath_validator/',
     keywords=['XPath', ],
+    python_requires='>=3.6',
+    extras_require={'numpy': ['numpy']},
     license='MIT',
     classifiers=(
         'Development Status :: 5 - Production/Stable',
         'License :: OSI Approved :: MIT License',
         'Natural Language :: English',
         'Operating System :: OS Independent',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: Implementation',
         'Topic :: Software Development :: Libraries',
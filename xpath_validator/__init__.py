@@ -21,6 +21,8 @@ True
 True
 >>> validate('choose(false(), 1, 2) = 2', None)
 True
+>>> validate("${flag} = 'no' or format-date-time(., '%Y') > 2000", 'not a date', {'flag': 'no'})
+True
 >>> validate('contains("abc", .)', "b")
 True
 >>> validate('contains("abc", .)', "e")
@@ -87,6 +89,8 @@ False
 True
 >>> validate("substring-before('aa&bb', ${sep}) = 'aa'", "&", {'sep': '&'})
 True
+>>> validate("selected(${opts}, .)", 'peixe', {'opts': 'peixe "abac\'ate'})
+True
 >>> validate("normalize-space('    abacate ') = 'abacate'", None)
 True
 >>> validate("starts-with('abacate', 'ab')", None)
@@ -121,23 +125,58 @@ __version__ = "1.5.0"
 __license__ = "MIT"
 
 import datetime
+import re
+import time
 import uuid
 
+from array import array
+from functools import partial
 from math import floor, ceil
 
 from xpath_validator.xp_tokenize import tokenize
-from xpath_validator.xp_parse import parse
+from xpath_validator.xp_parse import parse, unparse, BinOp, Call, Chain, Dot, If, Literal, Name, Shared, Var
+from xpath_validator.xp_cache import LRUCache
+from xpath_validator.xp_codegen import generate
+from xpath_validator.xp_registry import FunctionRegistry, FunctionSpec
+from xpath_validator.xp_stats import Instrumentation
+from xpath_validator.xp_budget import Budget, BudgetExceeded
+from xpath_validator.xp_tier import TierPolicy
 
 
 RETURNS_BOOL_AUTO = True
 
+# compiled expressions used by validate(), keyed by the expression text and the
+# version of FUNCTION_REGISTRY; EXPRESSION_CACHE.resize(0) turns it off
+EXPRESSION_CACHE = LRUCache(maxsize=1024)
+
+# expressions in EXPRESSION_CACHE start on the interpreter and move to the
+# python backend after TIERING.threshold runs; TIERING.threshold = 0 turns
+# it off and TIERING.stats() counts the promotions
+TIERING = TierPolicy(threshold=1000)
+
+# the Instrumentation compile() and evaluate() report to, None when off
+INSTRUMENTATION = None
+
+
+def enable_instrumentation(slow_threshold=None):
+    '''
+    starts recording stage timings, function calls and, when slow_threshold
+    (seconds) is given, the expressions that take longer to evaluate
 
-class Symbol(str):
-    pass
+    functions are instrumented when expressions are compiled, so the
+    expression cache is cleared; expressions compiled before only report
+    their stages
+    '''
+    global INSTRUMENTATION
+    INSTRUMENTATION = Instrumentation(slow_threshold=slow_threshold)
+    EXPRESSION_CACHE.clear()
+    return INSTRUMENTATION
 
 
-class Function(str):
-    pass
+def disable_instrumentation():
+    global INSTRUMENTATION
+    INSTRUMENTATION = None
+    EXPRESSION_CACHE.clear()
 
 
 class XPathStr(str):
@@ -164,7 +203,6 @@ DATE_TIME_FORMATS = [
     "%Y-%m-%d %H:%M:%S.%f",  # '2006-10-25 14:30:59.000200'
     "%Y-%m-%d %H:%M",  # '2006-10-25 14:30'
     "%Y-%m-%d",  # '2006-10-25'
-    "%d/%m/%Y %H:%M:%S",  # '10/25/2006 14:30:59'
     "%d/%m/%Y %H:%M:%S.%f",  # '10/25/2006 14:30:59.000200'
     "%d/%m/%Y %H:%M",  # '10/25/2006 14:30'
     "%d/%m/%Y",  # '10/25/2006'
@@ -177,6 +215,71 @@ DATE_TIME_FORMATS = [
 ]
 
 
+_ISO_DATE_TIME = re.compile(
+    r"\d{4}-\d{2}-\d{2}(?:T\d{2}:\d{2}:\d{2}\.\d{6}Z?|(?: \d{2}:\d{2}(?::\d{2}(?:\.\d{6})?)?)?)\Z"
+)
+_fromisoformat = getattr(datetime.datetime, "fromisoformat", None)
+
+# parsed datetimes (or None) by input string
+DATE_TIME_CACHE = LRUCache(maxsize=4096)
+
+
+def _date_time_shape(s):
+    """
+    the formats a string can match are the ones with the same separators
+
+    >>> _date_time_shape('2019-05-14T19:13:35Z'), _date_time_shape('%d/%m/%Y')
+    ('T', '/')
+    """
+    if "T" in s:
+        return "T"
+    if "-" in s:
+        return "-"
+    if "/" in s:
+        return "/"
+    return ":"
+
+
+_DATE_TIME_FORMATS_BY_SHAPE = {}
+for _f in DATE_TIME_FORMATS:
+    _DATE_TIME_FORMATS_BY_SHAPE.setdefault(_date_time_shape(_f), []).append(_f)
+
+
+def _strptime(sdt):
+    for f in _DATE_TIME_FORMATS_BY_SHAPE.get(_date_time_shape(sdt), ()):
+        try:
+            return datetime.datetime.strptime(sdt, f)
+        except ValueError:
+            pass
+    return None
+
+
+def _parse_date_time(sdt):
+    """
+    >>> _parse_date_time('2019-05-14T19:13:35.450686Z')
+    datetime.datetime(2019, 5, 14, 19, 13, 35, 450686)
+    >>> _parse_date_time('14/05/19 19:13')
+    datetime.datetime(2019, 5, 14, 19, 13)
+    >>> _parse_date_time('2019-13-14') is None
+    True
+    """
+    if not isinstance(sdt, str):
+        return None
+    dt = DATE_TIME_CACHE.get(sdt, False)
+    if dt is not False:
+        return dt
+    dt = None
+    if _fromisoformat is not None and _ISO_DATE_TIME.match(sdt):
+        try:
+            dt = _fromisoformat(sdt.rstrip("Z"))
+        except ValueError:
+            pass
+    if dt is None:
+        dt = _strptime(sdt)
+    DATE_TIME_CACHE.put(sdt, dt)
+    return dt
+
+
 def _format_date_time(sdt, format):
     """
     >>> _format_date_time('2019-05-14T19:13:35.450686Z', '%H')
@@ -206,12 +309,13 @@ def _format_date_time(sdt, format):
     >>> _format_date_time('19:13', '%H')
     '19'
     """
-    for f in DATE_TIME_FORMATS:
-        try:
-            return datetime.datetime.strptime(sdt, f).strftime(format)
-        except Exception:
-            pass
-    return None
+    dt = _parse_date_time(sdt)
+    if dt is None:
+        return None
+    try:
+        return dt.strftime(format)
+    except Exception:
+        return None
 
 
 def _int(v):
@@ -274,7 +378,39 @@ def _selected(x, y):
     return y in x
 
 
-FUNCTIONS = {
+class _FunctionTable(dict):
+    """
+    a dict that counts its changes, so editing FUNCTIONS changes
+    FUNCTION_REGISTRY.version
+
+    >>> table = _FunctionTable(a=len)
+    >>> table['b'] = str
+    >>> del table['a']
+    >>> table.version
+    2
+    """
+
+    version = 0
+
+    def _changed(method):
+        def change(self, *args, **kwargs):
+            self.version += 1
+            return method(self, *args, **kwargs)
+
+        change.__name__ = method.__name__
+        return change
+
+    __setitem__ = _changed(dict.__setitem__)
+    __delitem__ = _changed(dict.__delitem__)
+    clear = _changed(dict.clear)
+    pop = _changed(dict.pop)
+    popitem = _changed(dict.popitem)
+    setdefault = _changed(dict.setdefault)
+    update = _changed(dict.update)
+    del _changed
+
+
+FUNCTIONS = _FunctionTable({
     "false": lambda: False,
     "true": lambda: True,
     "boolean": bool,
@@ -295,11 +431,94 @@ FUNCTIONS = {
     "substring_before": _substring_before,
     "uuid": _uuid,
     "selected": _selected,
+})
+
+# (arity, pure, cost) of the built-in functions; functions added to
+# FUNCTIONS without an entry are not checked and never treated as pure
+FUNCTION_METADATA = {
+    "false": (0, True, 1),
+    "true": (0, True, 1),
+    "boolean": (1, True, 1),
+    "not": (1, True, 1),
+    "choose": (3, True, 1),
+    "ceiling": (1, True, 1),
+    "floor": (1, True, 1),
+    "round": ((1, 2), True, 1),
+    "int": (1, True, 2),
+    "number": (1, True, 2),
+    "contains": (2, True, 2),
+    "format_date_time": (2, True, 20),
+    "normalize_space": (1, True, 2),
+    "starts_with": (2, True, 2),
+    "string": (1, True, 2),
+    "string_length": (1, True, 1),
+    "substring_after": (2, True, 5),
+    "substring_before": (2, True, 5),
+    "uuid": (0, False, 10),
+    "selected": (2, True, 2),
+}
+
+
+class _Builtins:
+    '''
+    FUNCTIONS seen as the root registry, read when an expression is
+    compiled; the specs are shared by every call site until FUNCTIONS
+    changes
+
+    >>> FUNCTION_REGISTRY.get('int') is FUNCTION_REGISTRY.get('int')
+    True
+    '''
+
+    def __init__(self):
+        self._cache = (None, {})
+
+    @property
+    def version(self):
+        return FUNCTIONS.version
+
+    def get(self, name):
+        version, specs = self._cache
+        if version != FUNCTIONS.version:
+            version, specs = self._cache = (FUNCTIONS.version, {})
+        spec = specs.get(name)
+        if spec is None:
+            if name not in FUNCTIONS:
+                return None
+            arity, pure, cost = FUNCTION_METADATA.get(name, (None, False, 1))
+            spec = specs[name] = FunctionSpec(name, FUNCTIONS[name], arity, pure, cost)
+        return spec
+
+    def specs(self):
+        return dict((name, self.get(name)) for name in FUNCTIONS)
+
+
+# the registry of compile() and validate() when none is given; tenants
+# extend it with FunctionRegistry(parent=FUNCTION_REGISTRY)
+FUNCTION_REGISTRY = FunctionRegistry(parent=_Builtins())
+
+# argument and result types of the built-in functions that never raise when
+# their arguments have these types (None: any type, or not known)
+_SAFE_FUNCTIONS = {
+    "false": ((), "bool"),
+    "true": ((), "bool"),
+    "boolean": ((None,), "bool"),
+    "not": ((None,), "bool"),
+    "int": ((None,), "number"),
+    "number": ((None,), "number"),
+    "string": ((None,), "string"),
+    "string_length": (("string",), "number"),
+    "contains": (("string", "string"), "bool"),
+    "starts_with": (("string", "string"), "bool"),
+    "selected": (("string", "string"), "bool"),
+    "normalize_space": (("string",), "string"),
+    "substring_after": (("string", "string"), "string"),
+    "substring_before": (("string", "string"), "string"),
+    # a string, or None when the date cannot be read
+    "format_date_time": ((None, None), None),
 }
 
 
 ENV = {
-    "$": lambda f, *args: FUNCTIONS[f](*args),
     "*": lambda x, y: x * y,
     "+": lambda x, y: x + y,
     "-": lambda x, y: x - y,
@@ -315,187 +534,841 @@ ENV = {
     ">=": lambda x, y: x >= y,
 }
 
+# ENV as shipped; generated code calls the operators changed since
+_BUILTIN_ENV = dict(ENV)
+
 
-def _lsp_atom(token):
+def _atom(value):
     '''
-    >>> type(_lsp_atom('$'))
-    <class 'xpath_validator.Symbol'>
-    >>> type(_lsp_atom('boolean'))
-    <class 'xpath_validator.Function'>
-    >>> type(_lsp_atom('selected'))
-    <class 'xpath_validator.Function'>
-    >>> type(_lsp_atom('peixe abacate'))
-    <class 'xpath_validator.XPathStr'>
-    >>> type(_lsp_atom('5')) == float
-    True
+    >>> _atom('5')
+    5.0
+    >>> _atom('peixe abacate')
+    'peixe abacate'
     '''
     try:
-        return float(token)
+        return float(value)
     except ValueError:
-        if token in FUNCTIONS.keys():
-            return Function(token)
-        if token in ENV.keys():
-            return Symbol(token)
-        return XPathStr(token)
-
-
-def _lsp_atomize(tokens):
-    '''
-    >>> _lsp_atomize(['(', '$', 'boolean', '(', '$', 'selected', 'peixe abacate', '.', ')', ')'])
-    ['$', 'boolean', ['$', 'selected', 'peixe abacate', '.']]
-    '''
-    if len(tokens) == 0:
-        raise SyntaxError("unexpected EOF")
-    token = tokens.pop(0)
-    if token == "(":
-        r = []
-        while tokens[0] != ")":
-            r.append(_lsp_atomize(tokens))
-        tokens.pop(0)
-        return r
-    elif token == ")":
-        raise SyntaxError("unexpected )")
-    else:
-        return _lsp_atom(token)
-
-
-def _lsp_split_atomize(program):
-    '''
-    _lsp_split_atomize(' ( $ boolean  ( $ selected "peixe abacate" . )  ) ')
-    ['(', '$', 'boolean', '(', '$', 'selected', 'peixe abacate', '.', ')', ')']
-    '''
-    string_delimiter = ''
-    atoms = []
-    atom = ''
-    program = program.replace(")", " ) ").replace("(", " ( ")
-    pl = len(program)
-    i = 0
-    while i < pl:
-        c = program[i]
-        if c not in ['"', "'"]:
-            if c == ' ':
-                atom_striped = atom.strip()
-                if atom_striped:
-                    atoms.append(atom_striped)
-                atom = ''
-            atom += c
-        else:
-            string_delimiter = c
-            i += 1
-            c = program[i]
-            atom += c
-            while c != string_delimiter:
-                i += 1
-                c = program[i]
-                if c not in ['"', "'"]:
-                    atom += c
-            i += 1
-            atom_striped = atom.strip()
-            if atom_striped:
-                atoms.append(atom_striped)
-            atom = ''
-        i += 1
-    return atoms
+        return XPathStr(value)
+
+
+def _bind(value):
+    '''
+    >>> _bind('&')
+    '&'
+    >>> _bind('10')
+    10.0
+    >>> _bind(10)
+    10.0
+    >>> _bind(True)
+    True
+    '''
+    if isinstance(value, str):
+        return _atom(value)
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    return value
+
+
+def _link(node, registry):
+    '''
+    turns a parse() tree into the tree that is evaluated, in place; calls
+    are resolved in registry
+
+    >>> _link(parse("choose(contains(., 'ab'), '5', x)", tokenize("choose(contains(., 'ab'), '5', x)")), FUNCTION_REGISTRY)
+    If(Call('contains', (Dot(), Literal('ab'))), Literal(5.0), Literal('x'))
+    '''
+    cls = node.__class__
+    if cls is Literal:
+        if isinstance(node.value, str):
+            node.value = _atom(node.value)
+    elif cls is Name:
+        return Literal(_atom(node.name))
+    elif cls is BinOp:
+        node.left = _link(node.left, registry)
+        node.right = _link(node.right, registry)
+    elif cls is Call:
+        node.args = tuple(_link(a, registry) for a in node.args)
+        node.spec = registry.resolve(node.name, len(node.args))
+        if node.spec.function is FUNCTIONS["choose"]:
+            # only the branch that is taken gets evaluated
+            test, then, orelse = node.args
+            if INSTRUMENTATION is not None:
+                # the test goes through a function reporting the call to choose
+                spec = INSTRUMENTATION.wrap(FunctionSpec("choose", _choice, 1, pure=True), time.perf_counter)
+                test = Call("choose", (test,), spec)
+            return If(test, then, orelse)
+        if INSTRUMENTATION is not None:
+            node.spec = INSTRUMENTATION.wrap(node.spec, time.perf_counter)
+    return node
+
+
+def _choice(test):
+    return test
 
 
-def _lsp_parse(program, data_node=""):
+def _children(node):
+    cls = node.__class__
+    if cls is BinOp:
+        return (node.left, node.right)
+    if cls is Call:
+        return node.args
+    if cls is If:
+        return (node.test, node.then, node.orelse)
+    if cls is Shared:
+        return (node.node,)
+    if cls is Chain:
+        return node.operands
+    return ()
+
+
+def _variables(node):
+    '''
+    >>> sorted(_variables(BinOp('and', Var('min'), Call('not', (Var('max'),)))))
+    ['max', 'min']
     '''
-    >>> _lsp_parse('($ boolean ($ selected "peixe abacate" .))', data_node="peixe")
-    ['$', 'boolean', ['$', 'selected', 'peixe abacate', 'peixe']]
+    if node.__class__ is Var:
+        return {node.name}
+    return set().union(*[_variables(child) for child in _children(node)])
+
+
+# the values that can be kept in a Literal or reused by a Shared node; an
+# iterator, like the map XPathStr division returns, is used up by the first
+# evaluation
+_CONSTANT_TYPES = frozenset([bool, int, float, str, XPathStr, type(None)])
+
+
+def _fold(node, static, meter=None):
     '''
-    a = _lsp_atomize(_lsp_split_atomize(program))
-    if isinstance(data_node, str):
-        data_node = XPathStr(data_node)
+    replaces the subtrees that do not depend on "." or on variables missing
+    from static by their value, in place
+
+    >>> _fold(compile("choose(true(), 1, 2) + string-length('abc')").tree, {})
+    Literal(4.0)
+    >>> _fold(compile('. > ${min} + 1 and ${max} > .').tree, {'min': 5.0})
+    BinOp('and', BinOp('>', Dot(), Literal(6.0)), BinOp('>', Var('max'), Dot()))
 
-    def replace_dot(atoms):
-        for i, e in enumerate(atoms):
-            if isinstance(e, list):
-                atoms[i] = replace_dot(e)
-            elif e == ".":
-                atoms[i] = data_node
-        return atoms
+    impure functions, operations that fail and values that are not constants
+    are left for evaluation
 
-    return replace_dot(a)
+    >>> _fold(compile('uuid() != "" or 1 div 0').tree, {})
+    BinOp('or', BinOp('!=', Call('uuid', ()), Literal('')), BinOp('div', Literal(1.0), Literal(0.0)))
+    >>> exp = compile("contains('a_b_c' div '_', .)")
+    >>> str(exp), [exp.evaluate(v) for v in 'bbca']
+    ('contains(("a_b_c" div "_"), .)', [True, True, True, True])
 
+    with a meter, subtrees over its budget are left too
+    '''
+    cls = node.__class__
+    if cls is Var:
+        if node.name in static:
+            return Literal(static[node.name])
+    elif cls is BinOp:
+        node.left = left = _fold(node.left, static, meter)
+        if left.__class__ is Literal and node.op in ("and", "or"):
+            # the value of "x and y" is x when x is false, y otherwise
+            if bool(left.value) == (node.op == "or"):
+                return left
+            return _fold(node.right, static, meter)
+        node.right = right = _fold(node.right, static, meter)
+        if left.__class__ is Literal and right.__class__ is Literal and node.op not in ("and", "or"):
+            try:
+                if meter is not None:
+                    _check_size(node.op, left.value, right.value, meter)
+                value = ENV[node.op](left.value, right.value)
+                if value.__class__ in _CONSTANT_TYPES:
+                    return Literal(value)
+            except Exception:
+                pass
+    elif cls is Call:
+        node.args = args = tuple(_fold(a, static, meter) for a in node.args)
+        if node.spec.pure and all(a.__class__ is Literal for a in args):
+            try:
+                value = node.spec.function(*[a.value for a in args])
+                if meter is not None and isinstance(value, str):
+                    meter.size(len(value))
+                if value.__class__ in _CONSTANT_TYPES:
+                    return Literal(value)
+            except Exception:
+                pass
+    elif cls is If:
+        node.test = test = _fold(node.test, static, meter)
+        if test.__class__ is Literal:
+            return _fold(node.then if test.value else node.orelse, static, meter)
+        node.then = _fold(node.then, static, meter)
+        node.orelse = _fold(node.orelse, static, meter)
+    return node
 
-def _lisp(t):
-    if "items" not in t:
-        if t["val"] == "":
-            return "''"
 
-        if t["type"] == "string":
-            if '"' in t["val"]:
-                return "'%s'" % t["val"]
-            else:
-                return '"%s"' % t["val"]
+def _safe(node):
+    '''
+    (safe, type) of a tree: safe when it is pure and cannot raise, type is
+    "bool", "number", "string" or None when it is not known
 
-        return t["val"]
-    args = "".join([" " + _lisp(tt) for tt in t["items"]])
-    return "(" + t["val"] + args + ")"
+    >>> _safe(compile("${flag} = 'yes'").tree)
+    (True, 'bool')
+    >>> _safe(compile("string-length(.) > 3").tree)
+    (False, 'bool')
+    '''
+    cls = node.__class__
+    if cls is Literal:
+        value = node.value
+        if isinstance(value, bool):
+            return True, "bool"
+        if isinstance(value, float):
+            return True, "number"
+        if isinstance(value, str):
+            return True, "string"
+        return True, None
+    if cls is Dot or cls is Var:
+        return True, None
+    if cls is Call:
+        types = _SAFE_FUNCTIONS.get(node.name)
+        if types is None or node.spec.function is not FUNCTIONS[node.name] or not node.spec.pure:
+            return False, None
+        safe = True
+        for arg, expected in zip(node.args, types[0]):
+            arg_safe, arg_type = _safe(arg)
+            safe = safe and arg_safe and (expected is None or arg_type == expected)
+        return safe, types[1]
+    if cls is If:
+        results = [_safe(n) for n in (node.test, node.then, node.orelse)]
+        same = results[1][1] if results[1][1] == results[2][1] else None
+        return all(r[0] for r in results), same
+    if cls is Chain:
+        results = [_safe(n) for n in node.operands]
+        return all(r[0] for r in results), "bool" if all(r[1] == "bool" for r in results) else None
+    if cls is not BinOp:
+        return False, None
+    left_safe, left_type = _safe(node.left)
+    right_safe, right_type = _safe(node.right)
+    safe = left_safe and right_safe
+    op = node.op
+    if op in ("and", "or"):
+        return safe, "bool" if left_type == right_type == "bool" else None
+    if op in ("=", "!="):
+        return safe, "bool"
+    if op in ("<", ">", "<=", ">="):
+        return safe and left_type == right_type and left_type in ("number", "string"), "bool"
+    if op in ("+", "-", "*"):
+        return safe and left_type == right_type == "number", "number"
+    # div and mod raise for zero
+    return False, "number"
 
 
-def _to_lsp(code, returns_bool):
+def _cost(node):
     '''
-    >>> _to_lsp("boolean(selected('peixe abacate', .))", True)
-    '($ boolean ($ selected "peixe abacate" .))'
+    static estimate of the work of evaluating a tree: one per operator,
+    the registered cost per function call
+
+    >>> _cost(compile("format-date-time(., '%d/%m') = '25/12'").tree), _cost(compile("${flag} = 'yes'").tree)
+    (21, 1)
     '''
-    if not code.startswith("boolean") and returns_bool:
-        code = "boolean(%s)" % code
-    tokens = tokenize(code)
-    tree = parse(code, tokens)
-    return _lisp(tree)
+    cls = node.__class__
+    if cls is Call:
+        return node.spec.cost + sum(_cost(a) for a in node.args)
+    if cls is BinOp:
+        return 1 + _cost(node.left) + _cost(node.right)
+    if cls is If:
+        return _cost(node.test) + max(_cost(node.then), _cost(node.orelse))
+    if cls is Chain:
+        return sum(_cost(o) for o in node.operands)
+    return 0
 
 
-def _xpath_boolean(x):
+def _chain(node, op):
+    """the operands of a chain of op, left to right"""
+    if node.__class__ is BinOp and node.op == op:
+        return _chain(node.left, op) + _chain(node.right, op)
+    return [node]
+
+
+def _reorder(node, adaptive=False):
     '''
-    >>> _xpath_boolean([Symbol('$'), Function('boolean'), [Symbol('$'), Function('selected'), XPathStr('peixe abacate'), XPathStr('peixe')]])
+    puts the cheaper operands of "and" and "or" first, in place, when all
+    the operands are pure, cannot raise and are booleans (so the result is
+    the same whichever operand decides it)
+
+    >>> str(compile("format-date-time(., '%d/%m') = '25/12' or ${flag} = 'yes'"))
+    '((${flag} = "yes") or (format_date_time(., "%d/%m") = "25/12"))'
+    >>> str(compile("string-length(.) > 3 and ${flag} = 'yes'"))
+    '((string_length(.) > 3) and (${flag} = "yes"))'
+
+    with adaptive, the chains become Chain nodes that the interpreter
+    reorders by how often each operand decides the result
+
+    >>> exp = compile(". = 'a' or . = 'b'", adaptive=True)
+    >>> str(exp)
+    '((. = "a") or (. = "b"))'
+    >>> all(exp.evaluate('b') for i in range(RELEARN))
     True
-    >>> _xpath_boolean([Symbol('$'), Function('boolean'), [Symbol('$'), Function('selected'), XPathStr('peixe abacate'), XPathStr('ola')]])
+    >>> str(exp)
+    '((. = "b") or (. = "a"))'
+    '''
+    cls = node.__class__
+    if cls is BinOp:
+        if node.op in ("and", "or"):
+            operands = [_reorder(o, adaptive) for o in _chain(node, node.op)]
+            if all(_safe(o) == (True, "bool") for o in operands):
+                costs = [_cost(o) for o in operands]
+                order = sorted(range(len(operands)), key=lambda i: costs[i])
+                operands = [operands[i] for i in order]
+                costs = [costs[i] for i in order]
+                if adaptive:
+                    n = len(operands)
+                    return Chain(node.op, operands, costs, [0] * n, [0] * n, 0)
+            tree = operands[0]
+            for operand in operands[1:]:
+                tree = BinOp(node.op, tree, operand)
+            return tree
+        node.left = _reorder(node.left, adaptive)
+        node.right = _reorder(node.right, adaptive)
+    elif cls is Call:
+        node.args = tuple(_reorder(a, adaptive) for a in node.args)
+    elif cls is If:
+        node.test = _reorder(node.test, adaptive)
+        node.then = _reorder(node.then, adaptive)
+        node.orelse = _reorder(node.orelse, adaptive)
+    return node
+
+
+# adaptive chains reorder their operands every RELEARN evaluations
+RELEARN = 256
+
+
+def _relearn(node):
+    '''
+    sorts the operands of a Chain by cost per decision: an operand that is
+    cheap and often decides the result goes first
+
+    >>> node = Chain('and', ['a', 'b'], [1, 5], [100, 100], [2, 90], 200)
+    >>> _relearn(node)
+    >>> node.operands, node.tried, node.decided
+    (['b', 'a'], [0, 0], [0, 0])
+    '''
+    n = len(node.operands)
+    # (decided + 1) / (tried + 2): operands never tried count as 1/2
+    rank = [node.costs[i] * (node.tried[i] + 2) / float(node.decided[i] + 1) for i in range(n)]
+    order = sorted(range(n), key=lambda i: rank[i])
+    costs = [node.costs[i] for i in order]
+    # new lists: evaluations running in other threads keep the old ones
+    node.operands, node.costs = [node.operands[i] for i in order], costs
+    node.tried, node.decided = [0] * n, [0] * n
+
+
+def _evaluate_chain(node, data_node, scope):
+    decides = node.op == "or"
+    operands, tried, decided = node.operands, node.tried, node.decided
+    value = None
+    for i in range(len(operands)):
+        tried[i] += 1
+        value = _evaluate(operands[i], data_node, scope)
+        if bool(value) == decides:
+            decided[i] += 1
+            break
+    node.evaluations += 1
+    if node.evaluations % RELEARN == 0:
+        _relearn(node)
+    return value
+
+
+def _check_tree(tree, budget):
+    '''
+    raises BudgetExceeded when tree is deeper or larger than budget allows
+
+    >>> _check_tree(parse('. + 1', tokenize('. + 1')), Budget(max_nodes=2))
+    Traceback (most recent call last):
+        ...
+    xpath_validator.xp_budget.BudgetExceeded: max_nodes exceeded (2)
+    '''
+    max_depth, max_nodes = budget.max_depth, budget.max_nodes
+    nodes = 0
+    stack = [(tree, 1)]
+    while stack:
+        node, depth = stack.pop()
+        nodes += 1
+        if max_nodes is not None and nodes > max_nodes:
+            raise BudgetExceeded("max_nodes", max_nodes)
+        if max_depth is not None and depth > max_depth:
+            raise BudgetExceeded("max_depth", max_depth)
+        for child in _children(node):
+            stack.append((child, depth + 1))
+
+
+def _check_size(op, left, right, meter):
+    # checked before the operation: the string would be built first
+    if op == "*":
+        if isinstance(left, str) and isinstance(right, int):
+            meter.size(len(left) * right)
+        elif isinstance(right, str) and isinstance(left, int):
+            meter.size(len(right) * left)
+    elif op == "+" and isinstance(left, str) and isinstance(right, str):
+        meter.size(len(left) + len(right))
+
+
+def _evaluate_budgeted(node, data_node, scope, meter):
+    '''
+    _evaluate() counting steps and checking result sizes against meter
+
+    >>> tree = compile('. * 2 > 3 and . * 2 < 10').tree
+    >>> _evaluate_budgeted(tree, 2.0, {}, Budget(max_steps=11).meter())
+    True
+    >>> _evaluate_budgeted(tree, 2.0, {}, Budget(max_steps=10).meter())
+    Traceback (most recent call last):
+        ...
+    xpath_validator.xp_budget.BudgetExceeded: max_steps exceeded (10)
+    '''
+    meter.step()
+    cls = node.__class__
+    if cls is BinOp:
+        op = node.op
+        if op == "and":
+            return _evaluate_budgeted(node.left, data_node, scope, meter) and _evaluate_budgeted(node.right, data_node, scope, meter)
+        if op == "or":
+            return _evaluate_budgeted(node.left, data_node, scope, meter) or _evaluate_budgeted(node.right, data_node, scope, meter)
+        left = _evaluate_budgeted(node.left, data_node, scope, meter)
+        right = _evaluate_budgeted(node.right, data_node, scope, meter)
+        _check_size(op, left, right, meter)
+        return ENV[op](left, right)
+    if cls is Dot:
+        return data_node
+    if cls is Literal:
+        return node.value
+    if cls is Var:
+        return scope[node.name]
+    if cls is Call:
+        value = node.spec.function(*[_evaluate_budgeted(a, data_node, scope, meter) for a in node.args])
+        if isinstance(value, str):
+            meter.size(len(value))
+        return value
+    if cls is Shared:
+        try:
+            return scope[node.key]
+        except KeyError:
+            value = _evaluate_budgeted(node.node, data_node, scope, meter)
+            if value.__class__ in _CONSTANT_TYPES:
+                scope[node.key] = value
+            return value
+    if cls is Chain:
+        value = None
+        for operand in node.operands:
+            value = _evaluate_budgeted(operand, data_node, scope, meter)
+            if bool(value) == (node.op == "or"):
+                break
+        return value
+    if _evaluate_budgeted(node.test, data_node, scope, meter):
+        return _evaluate_budgeted(node.then, data_node, scope, meter)
+    return _evaluate_budgeted(node.orelse, data_node, scope, meter)
+
+
+def _budgeted(tree, budget):
+    def run(data_node, scope):
+        return _evaluate_budgeted(tree, data_node, scope, budget.meter())
+
+    return run
+
+
+def _evaluate(node, data_node, scope):
+    '''
+    >>> tree = _link(Call('selected', (Var('opts'), Dot())), FUNCTION_REGISTRY)
+    >>> _evaluate(tree, XPathStr('peixe'), {'opts': 'peixe abacate'})
+    True
+
+    and, or and choose() only evaluate the operands they need
+
+    >>> _evaluate(BinOp('or', Literal(True), BinOp('div', Literal(1.0), Literal(0.0))), None, {})
+    True
+    >>> _evaluate(If(Literal(False), BinOp('div', Literal(1.0), Literal(0.0)), Literal(2.0)), None, {})
+    2.0
+    '''
+    cls = node.__class__
+    if cls is BinOp:
+        op = node.op
+        if op == "and":
+            return _evaluate(node.left, data_node, scope) and _evaluate(node.right, data_node, scope)
+        if op == "or":
+            return _evaluate(node.left, data_node, scope) or _evaluate(node.right, data_node, scope)
+        return ENV[op](_evaluate(node.left, data_node, scope), _evaluate(node.right, data_node, scope))
+    if cls is Dot:
+        return data_node
+    if cls is Literal:
+        return node.value
+    if cls is Var:
+        return scope[node.name]
+    if cls is Call:
+        return node.spec.function(*[_evaluate(a, data_node, scope) for a in node.args])
+    if cls is Shared:
+        try:
+            return scope[node.key]
+        except KeyError:
+            value = _evaluate(node.node, data_node, scope)
+            if value.__class__ in _CONSTANT_TYPES:
+                scope[node.key] = value
+            return value
+    if cls is Chain:
+        return _evaluate_chain(node, data_node, scope)
+    if _evaluate(node.test, data_node, scope):
+        return _evaluate(node.then, data_node, scope)
+    return _evaluate(node.orelse, data_node, scope)
+
+
+def _pairs(data_nodes, contexts):
+    '''
+    zip() that raises when one iterable is shorter than the other
+
+    >>> list(_pairs([1, 2], ['a']))
+    Traceback (most recent call last):
+        ...
+    ValueError: 1 contexts for more data nodes
+    '''
+    contexts = iter(contexts)
+    count = 0
+    for data_node in data_nodes:
+        try:
+            context = next(contexts)
+        except StopIteration:
+            raise ValueError("%d contexts for more data nodes" % count)
+        count += 1
+        yield data_node, context
+    for _ in contexts:
+        raise ValueError("more contexts than the %d data nodes" % count)
+
+
+class CompiledExpression:
+    '''
+    An expression parsed once and evaluated many times
+
+    >>> exp = compile('. >= 1 and . <= 100')
+    >>> exp.evaluate(10)
+    True
+    >>> exp.evaluate(101)
+    False
+    >>> exp = compile('. >= ${min} and . <= ${max}')
+    >>> exp.evaluate(10, {"max": 100, "min": 10})
+    True
+    >>> exp.evaluate(10, {"max": 100, "min": 20})
     False
+    >>> compile('(. div -5)').evaluate(10, returns_bool=False)
+    -2.0
+    >>> sorted(exp.variables)
+    ['max', 'min']
+
+    backend="python" compiles the tree to a Python function instead of
+    walking it on every evaluation
+
+    >>> exp = compile('. >= ${min} and . <= ${max}', backend="python")
+    >>> exp.evaluate(10, {"max": 100, "min": 10})
+    True
+    >>> exp.backend
+    'python'
+
+    functions are looked up in registry (FUNCTION_REGISTRY by default) when
+    the expression is compiled, unknown functions and wrong numbers of
+    arguments are errors then
+
+    >>> compile('floor(., 2)')
+    Traceback (most recent call last):
+        ...
+    TypeError: floor() takes 1 argument (2 given)
+
+    constant subtrees are computed once, when the expression is compiled;
+    static_context gives the variables that are the same for every
+    evaluation, and str(exp) shows what is left to evaluate
+
+    >>> exp = compile('. >= ${min} * 2 and contains(${sep}, .)', static_context={'min': 5})
+    >>> str(exp)
+    '((. >= 10) and contains(${sep}, .))'
+    >>> sorted(exp.variables)
+    ['sep']
     '''
-    if isinstance(x, Symbol):
-        return ENV[x]
-    elif not isinstance(x, list):
-        return x
-    else:
-        return _xpath_boolean(x[0])(*[_xpath_boolean(exp) for exp in x[1:]])
 
+    def __init__(
+        self, expression, backend="interpreter", registry=None, static_context=None, budget=None, adaptive=False
+    ):
+        if backend not in BACKENDS:
+            raise ValueError("unknown backend %r" % backend)
+        if registry is None:
+            registry = FUNCTION_REGISTRY
+        static = {}
+        if static_context:
+            for name, value in static_context.items():
+                static[name] = _bind(value)
+        if INSTRUMENTATION is None and budget is None:
+            tree = _fold(_link(parse(expression, tokenize(expression)), registry), static)
+        else:
+            tree = self._compile_tree(INSTRUMENTATION, budget, expression, registry, static)
+        tree = _reorder(tree, adaptive)
+        self._setup(expression, tree, backend, registry, budget=budget)
+
+    @staticmethod
+    def _compile_tree(instrumentation, budget, expression, registry, static):
+        clock = time.perf_counter
+        start = clock()
+        tokens = tokenize(expression)
+        tokenized = clock()
+        try:
+            tree = parse(expression, tokens)
+            parsed = clock()
+            meter = None
+            if budget is not None:
+                _check_tree(tree, budget)
+                meter = budget.meter()
+            tree = _fold(_link(tree, registry), static, meter)
+        except RecursionError:
+            # deeper than Python can go, whatever max_depth allows
+            if budget is None:
+                raise
+            raise BudgetExceeded("max_depth", budget.max_depth)
+        if instrumentation is not None:
+            instrumentation.stage("tokenize", tokenized - start)
+            instrumentation.stage("parse", parsed - tokenized)
+            instrumentation.stage("link", clock() - parsed)
+        return tree
+
+    @classmethod
+    def _from_tree(cls, expression, tree, backend="interpreter", registry=None, variables=None):
+        """a compiled expression for a tree already linked and folded"""
+        if backend not in BACKENDS:
+            raise ValueError("unknown backend %r" % backend)
+        self = cls.__new__(cls)
+        self._setup(expression, tree, backend, registry or FUNCTION_REGISTRY, variables)
+        return self
+
+    def _setup(self, expression, tree, backend, registry, variables=None, budget=None):
+        self.expression = expression
+        self.registry = registry
+        self._wraps = not expression.startswith("boolean")
+        self.tree = tree
+        if variables is None:
+            variables = _variables(tree)
+        self.variables = frozenset(variables)
+        self.backend = backend
+        self.budget = budget
+        if budget is not None and budget.runtime:
+            # steps are counted by the interpreter, whatever the backend
+            self._run = _budgeted(tree, budget)
+        else:
+            self._run = BACKENDS[backend](tree)
+
+    def _tier(self, policy):
+        """counts the runs on the interpreter, moving to the python backend after policy.threshold"""
+        interpret = self._run
+        self.runs = 0
+
+        def run(data_node, scope):
+            if self.backend == "python":
+                # promoted while a batch was holding this function
+                return self._run(data_node, scope)
+            self.runs += 1
+            if policy.threshold and self.runs >= policy.threshold:
+                self._promote(policy)
+                return self._run(data_node, scope)
+            return interpret(data_node, scope)
+
+        self._run = run
+
+    def _promote(self, policy):
+        with policy.lock:
+            if self.backend == "python":
+                return
+            self._run = BACKENDS["python"](self.tree)
+            self.backend = "python"
+            policy.promotions += 1
+
+    def __str__(self):
+        return unparse(self.tree)
+
+    def _scope(self, context):
+        scope = {}
+        if self.variables:
+            if context is None:
+                context = {}
+            for name in self.variables:
+                scope[name] = _bind(context[name])
+        return scope
+
+    def evaluate(self, data_node, context=None, returns_bool=RETURNS_BOOL_AUTO):
+        if INSTRUMENTATION is not None:
+            return self._instrumented_evaluate(INSTRUMENTATION, data_node, context, returns_bool)
+        scope = self._scope(context)
+        if isinstance(data_node, str):
+            data_node = XPathStr(data_node)
+        result = self._run(data_node, scope)
+        if returns_bool and self._wraps:
+            return bool(result)
+        return result
+
+    def _instrumented_evaluate(self, instrumentation, data_node, context, returns_bool):
+        clock = time.perf_counter
+        start = clock()
+        scope = self._scope(context)
+        if isinstance(data_node, str):
+            data_node = XPathStr(data_node)
+        prepared = clock()
+        result = self._run(data_node, scope)
+        end = clock()
+        instrumentation.stage("prepare", prepared - start)
+        instrumentation.stage("evaluate", end - prepared)
+        instrumentation.evaluated(self.expression, end - start)
+        if returns_bool and self._wraps:
+            return bool(result)
+        return result
+
+    def _evaluate_many(self, data_nodes, contexts, pairs, returns_bool):
+        run = self._run
+        as_bool = returns_bool and self._wraps
+        if pairs:
+            items = data_nodes
+        elif contexts is None or isinstance(contexts, dict):
+            # one context for every item: bind it once
+            scope = self._scope(contexts)
+            for data_node in data_nodes:
+                if isinstance(data_node, str):
+                    data_node = XPathStr(data_node)
+                result = run(data_node, scope)
+                yield bool(result) if as_bool else result
+            return
+        else:
+            items = _pairs(data_nodes, contexts)
+        for data_node, context in items:
+            if isinstance(data_node, str):
+                data_node = XPathStr(data_node)
+            result = run(data_node, self._scope(context))
+            yield bool(result) if as_bool else result
+
+    def _instrumented_many(self, instrumentation, results):
+        """reports every item of a batch, prepare included in evaluate"""
+        clock = time.perf_counter
+        while True:
+            start = clock()
+            try:
+                result = next(results)
+            except StopIteration:
+                return
+            seconds = clock() - start
+            instrumentation.stage("evaluate", seconds)
+            instrumentation.evaluated(self.expression, seconds)
+            yield result
+
+    def evaluate_many(self, data_nodes, contexts=None, returns_bool=RETURNS_BOOL_AUTO, pairs=False, output="results"):
+        '''
+        evaluates the expression for every item of an iterable
+
+        - contexts: None, one context for every item or an iterable of
+          contexts, one per item (ValueError when the counts differ)
+        - pairs: data_nodes yields (data_node, context) pairs
+        - output: "results" yields every result, "array" returns an
+          array.array of 0/1 and "failures" yields the indexes of the items
+          whose result is false
+
+        >>> exp = compile('. >= ${min}')
+        >>> list(exp.evaluate_many([1, 5, 10], {'min': 5}))
+        [False, True, True]
+        >>> list(exp.evaluate_many([1, 5, 10], [{'min': 0}, {'min': 6}, {'min': 10}]))
+        [True, False, True]
+        >>> exp.evaluate_many([(1, {'min': 0}), (5, {'min': 6})], pairs=True, output="array")
+        array('b', [1, 0])
+        >>> list(exp.evaluate_many(iter(range(10)), {'min': 3}, output="failures"))
+        [0, 1, 2]
+        '''
+        results = self._evaluate_many(data_nodes, contexts, pairs, returns_bool)
+        if INSTRUMENTATION is not None:
+            results = self._instrumented_many(INSTRUMENTATION, results)
+        if output == "results":
+            return results
+        if output == "array":
+            return array("b", map(bool, results))
+        if output == "failures":
+            return (i for i, result in enumerate(results) if not result)
+        raise ValueError("unknown output %r" % output)
 
-def _prepare_ctx(ctx):
+
+def _generate(tree):
     '''
-    >>> _prepare_ctx({'sep': '&'})
-    {'sep': "'&'"}
+    operators replaced in ENV are called like the interpreter calls them
+
+    >>> equal = ENV['=']
+    >>> ENV['='] = lambda x, y: x.lower() == y.lower()
+    >>> _generate(compile(". = 'ABC'").tree)(XPathStr('abc'), {})
+    True
+    >>> ENV['='] = equal
     '''
-    new_ctx = {}
-    for d, v in ctx.items():
-        if isinstance(v, str):
-            if "'" in v:
-                v = '"%s"' % v
-            else:
-                v = "'%s'" % v
-        new_ctx[d] = v
-    return new_ctx
+    overridden = frozenset(op for op, function in ENV.items() if function is not _BUILTIN_ENV.get(op))
+    try:
+        return generate(tree, FUNCTIONS, ENV, overridden)
+    except (SyntaxError, RecursionError, MemoryError):
+        # too deeply nested for the Python compiler
+        return partial(_evaluate, tree)
+
+
+BACKENDS = {
+    "interpreter": lambda tree: partial(_evaluate, tree),
+    "python": _generate,
+}
 
 
-def _prepare_expression(exp, data):
+def compile(expression, backend="interpreter", registry=None, static_context=None, budget=None, adaptive=False):
     '''
-    >>> _prepare_expression('. >= ${min} and . <= ${max}', {'max': 100, 'min': 10})
-    '. >= 10 and . <= 100'
+    >>> compile('5 + 5 = .').evaluate(10)
+    True
+    >>> compile('.').evaluate(10, returns_bool=False)
+    10
     '''
-    exp = exp.replace("${", "{")
-    exp = exp.format(**data)
-    for func_name in FUNCTIONS.keys():
-        nf = func_name.replace("_", "-")
-        exp = exp.replace(nf, func_name)
-    return exp
+    return CompiledExpression(
+        expression, backend=backend, registry=registry, static_context=static_context, budget=budget, adaptive=adaptive
+    )
 
 
-def validate(expression, data_node, context={}, returns_bool=RETURNS_BOOL_AUTO):
+def _cached_compile(expression, budget=None):
+    '''
+    >>> _cached_compile('5 < .') is _cached_compile('5 < .')
+    True
+
+    registering a function, or changing FUNCTIONS, compiles the expressions
+    again
+
+    >>> contains = FUNCTIONS['contains']
+    >>> FUNCTIONS['contains'] = lambda x, y: False
+    >>> validate('contains(., "a")', 'abc')
+    False
+    >>> FUNCTIONS['contains'] = contains
+    >>> validate('contains(., "a")', 'abc')
+    True
+    '''
+    if not EXPRESSION_CACHE.enabled:
+        return compile(expression, budget=budget)
+    # expressions compiled before a function was registered are not reused
+    version = FUNCTION_REGISTRY.version
+    key = (expression, version) if budget is None else (expression, version, budget)
+    compiled = EXPRESSION_CACHE.get(key)
+    if compiled is None:
+        compiled = compile(expression, budget=budget)
+        if TIERING.enabled and (budget is None or not budget.runtime):
+            compiled._tier(TIERING)
+        EXPRESSION_CACHE.put(key, compiled)
+    return compiled
+
+
+def validate(expression, data_node, context={}, returns_bool=RETURNS_BOOL_AUTO, budget=None):
     '''
     >>> validate('. >= 10 and . <= 100', 10, {'max': 100, 'min': 10})
     True
+
+    budget (a Budget) limits the size of the expression and the work and
+    memory of the evaluation, raising BudgetExceeded
+    '''
+    return _cached_compile(expression, budget).evaluate(data_node, context, returns_bool=returns_bool)
+
+
+def validate_many(
+    expression, data_nodes, contexts=None, returns_bool=RETURNS_BOOL_AUTO, pairs=False, output="results", budget=None
+):
+    '''
+    validate() for a whole iterable of data nodes, see
+    CompiledExpression.evaluate_many
+
+    >>> list(validate_many('(. mod 2) = 0', [10, 11, 12], output="failures"))
+    [1]
     '''
-    expression = _prepare_expression(expression, _prepare_ctx(context))
-    lsp_code = _to_lsp(expression, returns_bool=returns_bool)
-    lsp_parsed = _lsp_parse(lsp_code, data_node=data_node)
-    return _xpath_boolean(lsp_parsed)
+    return _cached_compile(expression, budget).evaluate_many(
+        data_nodes, contexts, returns_bool=returns_bool, pairs=pairs, output=output
+    )
@@ -0,0 +1,6 @@
+import sys
+
+from xpath_validator.xp_bulk import main
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,153 @@
+"""
+    Rule packs compiled ahead of time to Python modules
+
+    write_module() turns a rule pack (field name -> expression) into the
+    source of a module with one plain Python function per rule, so workers
+    import it instead of tokenizing, parsing and linking; the bytecode is
+    cached in __pycache__ like any other module.  Functions are looked up
+    in FUNCTIONS when the module is imported, so they keep the interpreter's
+    semantics, and SOURCE_HASH is the hash of the rule pack the module was
+    written from.
+
+    >>> import importlib.util, os, tempfile
+    >>> from xpath_validator import validate
+    >>> pack = {
+    ...     'age': '. >= ${min} and . <= 10 * 12',
+    ...     'code': "starts-with(., 'br-') and string-length(.) = 8",
+    ...     'born': "int(format-date-time(., '%Y')) > 1900",
+    ...     'half': 'choose(. > 1, . div 2, number(.))',
+    ...     'even': '(. mod 2) = 0 or not(number(.) = number(.))',
+    ... }
+    >>> path = os.path.join(tempfile.mkdtemp(), 'form_rules.py')
+    >>> write_module(path, pack)
+    >>> spec = importlib.util.spec_from_file_location('form_rules', path)
+    >>> rules = importlib.util.module_from_spec(spec)
+    >>> spec.loader.exec_module(rules)
+    >>> rules.validate('age', 50, {'min': 18}), rules.validate('code', 'br-12345')
+    (True, True)
+    >>> stale(rules, pack), stale(rules, dict(pack, age='. > 0'))
+    (False, True)
+
+    the module gives the same results as validate()
+
+    >>> values = [0, 3, 18, 120, 121, '7', 'br-12345', 'br-1', 'x', '2019-05-14T19:13:35.450686Z', '1850-01-01']
+    >>> for field, expression in sorted(pack.items()):
+    ...     for value in values:
+    ...         try:
+    ...             expected = repr(validate(expression, value, {'min': 18}, returns_bool=False))
+    ...         except Exception as e:
+    ...             expected = type(e).__name__
+    ...         try:
+    ...             got = repr(rules.validate(field, value, {'min': 18}, returns_bool=False))
+    ...         except Exception as e:
+    ...             got = type(e).__name__
+    ...         assert got == expected, (field, value, got, expected)
+"""
+
+import hashlib
+import json
+import math
+import os
+
+from xpath_validator import FUNCTIONS, RETURNS_BOOL_AUTO, XPathStr, __version__, _bind, compile
+from xpath_validator.xp_codegen import to_source
+
+
+class Rule:
+    """one rule of a compiled module, evaluated like CompiledExpression.evaluate"""
+
+    __slots__ = ("field", "expression", "function", "variables", "_wraps")
+
+    def __init__(self, field, expression, function, variables):
+        self.field = field
+        self.expression = expression
+        self.function = function
+        self.variables = variables
+        self._wraps = not expression.startswith("boolean")
+
+    def evaluate(self, data_node, context=None, returns_bool=RETURNS_BOOL_AUTO):
+        scope = {}
+        if self.variables:
+            if context is None:
+                context = {}
+            for name in self.variables:
+                scope[name] = _bind(context[name])
+        if isinstance(data_node, str):
+            data_node = XPathStr(data_node)
+        result = self.function(data_node, scope)
+        if returns_bool and self._wraps:
+            return bool(result)
+        return result
+
+
+def source_hash(rules):
+    '''
+    >>> source_hash({'a': '. > 1'}) == source_hash({'a': '. > 1'}) != source_hash({'a': '. > 2'})
+    True
+    '''
+    text = json.dumps(sorted(rules.items()), ensure_ascii=False)
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def stale(module, rules):
+    """whether module was written from other rules or by another library version"""
+    return module.SOURCE_HASH != source_hash(rules) or module.LIBRARY_VERSION != __version__
+
+
+def _spell(value):
+    '''
+    the source of a value bound by the generated code
+
+    >>> _spell(XPathStr('br-')), _spell(float('nan')), _spell(FUNCTIONS['int'])
+    ("XPathStr('br-')", "float('nan')", "FUNCTIONS['int']")
+    '''
+    if value is FUNCTIONS:
+        return "FUNCTIONS"
+    if value.__class__ is XPathStr:
+        return "XPathStr(%r)" % str(value)
+    if value.__class__ is float and (math.isnan(value) or math.isinf(value)):
+        return "float(%r)" % repr(value)
+    if value is None or value.__class__ in (bool, int, float, str):
+        return repr(value)
+    for name, function in FUNCTIONS.items():
+        if value is function:
+            return "FUNCTIONS[%r]" % name
+    raise ValueError("%r can not be written to a module" % (value,))
+
+
+def to_module_source(rules):
+    """the source of the module for rules; only built-in functions can be used"""
+    lines = [
+        "# generated by xpath_validator.xp_aot, do not edit",
+        "from xpath_validator import FUNCTIONS, XPathStr",
+        "from xpath_validator.xp_aot import Rule",
+        "",
+        "LIBRARY_VERSION = %r" % __version__,
+        "SOURCE_HASH = %r" % source_hash(rules),
+        "",
+    ]
+    entries = []
+    for i, (field, expression) in enumerate(sorted(rules.items())):
+        exp = compile(expression)
+        name = "_rule_%d" % i
+        try:
+            source, names = to_source(exp.tree, FUNCTIONS, name=name, spell=_spell)
+        except ValueError as e:
+            raise ValueError("rule %r: %s" % (field, e))
+        lines.extend(["", source, ""])
+        entries.append("    %r: Rule(%r, %r, %s, %r)," % (field, field, expression, name, tuple(sorted(exp.variables))))
+    lines.extend(["", "RULES = {"] + entries + ["}", "", ""])
+    lines.extend([
+        "def validate(field, data_node, context=None, returns_bool=True):",
+        "    return RULES[field].evaluate(data_node, context, returns_bool)",
+    ])
+    return "\n".join(lines) + "\n"
+
+
+def write_module(path, rules):
+    """writes the module for rules to path, replacing it atomically"""
+    source = to_module_source(rules)
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(source)
+    os.replace(tmp, path)
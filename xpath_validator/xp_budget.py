@@ -0,0 +1,92 @@
+"""
+    Resource limits for untrusted expressions
+
+    >>> from xpath_validator import compile, validate
+    >>> budget = Budget(max_steps=50, max_size=1000, max_depth=20, max_nodes=100, timeout=0.5)
+    >>> validate('. >= 1 and . <= 100', 10, budget=budget)
+    True
+    >>> validate("string-length(substring-before(., 'x') * int(${n})) > 0", 'abcx', {'n': 10 ** 9}, budget=budget)
+    Traceback (most recent call last):
+        ...
+    xpath_validator.xp_budget.BudgetExceeded: max_size exceeded (1000)
+    >>> compile(' + '.join(['.'] * 200), budget=budget)
+    Traceback (most recent call last):
+        ...
+    xpath_validator.xp_budget.BudgetExceeded: max_depth exceeded (20)
+"""
+
+import time
+
+
+class BudgetExceeded(Exception):
+    """an expression went over its Budget; limit is the name of the limit"""
+
+    def __init__(self, limit, value):
+        Exception.__init__(self, "%s exceeded (%s)" % (limit, value))
+        self.limit = limit
+
+
+class Budget:
+    '''
+    limits checked when an expression is compiled (max_depth, max_nodes)
+    and on every evaluation (max_steps, max_size, timeout in seconds);
+    None is no limit
+
+    >>> Budget(max_steps=10) == Budget(max_steps=10)
+    True
+    '''
+
+    __slots__ = ("max_steps", "max_size", "max_depth", "max_nodes", "timeout")
+
+    def __init__(self, max_steps=None, max_size=None, max_depth=None, max_nodes=None, timeout=None):
+        self.max_steps = max_steps
+        self.max_size = max_size
+        self.max_depth = max_depth
+        self.max_nodes = max_nodes
+        self.timeout = timeout
+
+    def _key(self):
+        return tuple(getattr(self, k) for k in self.__slots__)
+
+    def __eq__(self, other):
+        return isinstance(other, Budget) and self._key() == other._key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        return "Budget(%s)" % ", ".join("%s=%r" % (k, getattr(self, k)) for k in self.__slots__)
+
+    @property
+    def runtime(self):
+        """whether evaluations need to be metered"""
+        return self.max_steps is not None or self.max_size is not None or self.timeout is not None
+
+    def meter(self):
+        return _Meter(self)
+
+
+class _Meter:
+    """what is left of a budget during one evaluation"""
+
+    __slots__ = ("steps", "budget", "max_size", "deadline")
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.steps = budget.max_steps if budget.max_steps is not None else float("inf")
+        self.max_size = budget.max_size
+        self.deadline = time.perf_counter() + budget.timeout if budget.timeout is not None else None
+
+    def step(self):
+        self.steps -= 1
+        if self.steps < 0:
+            raise BudgetExceeded("max_steps", self.budget.max_steps)
+        if self.deadline is not None and time.perf_counter() > self.deadline:
+            raise BudgetExceeded("timeout", self.budget.timeout)
+
+    def size(self, size):
+        if self.max_size is not None and size > self.max_size:
+            raise BudgetExceeded("max_size", self.max_size)
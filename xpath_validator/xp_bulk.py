@@ -0,0 +1,151 @@
+"""
+    Bulk validation of CSV/JSONL records on a pool of worker processes
+
+    python -m xpath_validator rules.json records.csv --workers 4 > failures.jsonl
+
+    The rule file maps field names to expressions.  Every field with a rule
+    is checked in every record, "." is the field value and ${name} the value
+    of the field "name" in the same record.  CSV values are strings, so
+    numeric rules should use number(.).  Each failure is one JSON line.
+
+    >>> import io
+    >>> rules = {'age': 'number(.) >= 18', 'name': 'string-length(.) > 0'}
+    >>> records = read_records(io.StringIO('name,age\\nana,30\\n,12\\n'), 'csv')
+    >>> for failure in check_records(rules, records):
+    ...     print(failure)
+    {'record': 1, 'field': 'age', 'value': '12'}
+    {'record': 1, 'field': 'name', 'value': ''}
+    >>> records = read_records(io.StringIO(
+    ...     '{"age": 3, "min": 5}\\n{"age": 40, "min": 5}\\n{"age": "x", "min": 5}\\n'
+    ... ), 'jsonl')
+    >>> for failure in check_records({'age': '. > ${min}'}, records, workers=2, chunk_size=1):
+    ...     print(failure)
+    {'record': 0, 'field': 'age', 'value': 3}
+    {'record': 2, 'field': 'age', 'value': 'x', 'error': "TypeError: '>' not supported between instances of 'XPathStr' and 'float'"}
+"""
+
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import sys
+
+from collections import deque
+from itertools import islice
+
+from xpath_validator import compile
+
+# the compiled rule set of a worker process
+_RULES = None
+
+
+def load_rules(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def read_records(stream, format):
+    if format == "csv":
+        return csv.DictReader(stream)
+    if format == "jsonl":
+        return (json.loads(line) for line in stream if line.strip())
+    raise ValueError("unknown format %r" % format)
+
+
+def _compile_rules(rules):
+    return [(field, compile(expression, backend="python")) for field, expression in sorted(rules.items())]
+
+
+def _init_worker(rules):
+    global _RULES
+    _RULES = _compile_rules(rules)
+
+
+def _check_chunk(chunk, rules=None):
+    if rules is None:
+        rules = _RULES
+    failures = []
+    for index, record in chunk:
+        for field, exp in rules:
+            value = record.get(field)
+            failure = None
+            try:
+                if not exp.evaluate(value, record):
+                    failure = {"record": index, "field": field, "value": value}
+            except Exception as e:
+                failure = {"record": index, "field": field, "value": value, "error": "%s: %s" % (type(e).__name__, e)}
+            if failure is not None:
+                failures.append(failure)
+    return failures
+
+
+def _chunks(records, chunk_size):
+    records = enumerate(records)
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def check_records(rules, records, workers=1, chunk_size=1000):
+    """
+    yields the failures of an iterable of records, in record order
+
+    records are read and sent to the workers in chunks, with at most two
+    chunks per worker in flight, so memory does not grow with the input
+    """
+    if workers <= 1:
+        compiled = _compile_rules(rules)
+        for chunk in _chunks(records, chunk_size):
+            for failure in _check_chunk(chunk, compiled):
+                yield failure
+        return
+    pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(rules,))
+    try:
+        pending = deque()
+        for chunk in _chunks(records, chunk_size):
+            pending.append(pool.apply_async(_check_chunk, (chunk,)))
+            if len(pending) >= 2 * workers:
+                for failure in pending.popleft().get():
+                    yield failure
+        while pending:
+            for failure in pending.popleft().get():
+                yield failure
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m xpath_validator",
+        description="validate the fields of CSV/JSONL records, failures are written as JSONL",
+    )
+    parser.add_argument("rules", help="JSON file mapping field names to expressions")
+    parser.add_argument("records", help="CSV or JSONL file, - for stdin")
+    parser.add_argument("--format", choices=["csv", "jsonl"], help="default: from the file extension")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--output", default="-", help="default: stdout")
+    args = parser.parse_args(argv)
+
+    format = args.format
+    if format is None:
+        format = "csv" if args.records.endswith(".csv") else "jsonl"
+    rules = load_rules(args.rules)
+    source = sys.stdin if args.records == "-" else open(args.records, newline="")
+    output = sys.stdout if args.output == "-" else open(args.output, "w")
+    failed = 0
+    try:
+        records = read_records(source, format)
+        for failure in check_records(rules, records, workers=args.workers, chunk_size=args.chunk_size):
+            output.write(json.dumps(failure) + "\n")
+            failed += 1
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if output is not sys.stdout:
+            output.close()
+    return 1 if failed else 0
@@ -0,0 +1,264 @@
+"""
+    Whole-form validation
+
+    FormValidator compiles the rules of every field of a form together.
+    Identical pure subexpressions, within a rule or across rules, are
+    evaluated at most once per submission.  "." is the value of the rule's
+    field and ${name} the value of the field "name" (or of the context).
+
+    >>> form = FormValidator({
+    ...     'birth': "int(format-date-time(., '%Y')) >= 1900 and int(format-date-time(., '%Y')) <= 2019",
+    ...     'age': ". >= 0 and . = 2019 - int(format-date-time(${birth}, '%Y'))",
+    ... })
+    >>> form.shared[0]
+    Shared(('#', 0), Call('int', (Call('format_date_time', (Dot(), Literal('%Y'))),)))
+    >>> form.validate({'birth': '1990-01-01', 'age': 29})
+    {'age': True, 'birth': True}
+    >>> form.validate({'birth': '1880-01-01', 'age': 139})
+    {'age': True, 'birth': False}
+
+    format-date-time runs once for "." of birth and once for ${birth}
+
+    >>> from xpath_validator import FUNCTION_REGISTRY, FUNCTIONS
+    >>> from xpath_validator.xp_registry import FunctionRegistry
+    >>> calls = []
+    >>> counting = FunctionRegistry(parent=FUNCTION_REGISTRY)
+    >>> counting.register('format_date_time', lambda *args: calls.append(args) or FUNCTIONS['format_date_time'](*args), 2, pure=True)
+    >>> form = FormValidator(form.rules, registry=counting)
+    >>> form.validate({'birth': '1990-01-01', 'age': 29})
+    {'age': True, 'birth': True}
+    >>> len(calls)
+    2
+
+    subexpressions are only shared when their literals have the same type
+
+    >>> form = FormValidator({
+    ...     'a': 'string(choose(${x} > 0, true(), 0))',
+    ...     'b': 'string(choose(${x} > 0, 1, 0))',
+    ... })
+    >>> form.validate({'x': 1, 'a': None, 'b': None}, returns_bool=False)
+    {'a': 'True', 'b': '1.0'}
+
+    values that are not constants, like the parts of a string division, are
+    evaluated again instead of being reused
+
+    >>> form = FormValidator({
+    ...     'a': "contains(${parts} div '_', .)",
+    ...     'b': "contains(${parts} div '_', .)",
+    ... })
+    >>> form.validate({'parts': 'x_y', 'a': 'y', 'b': 'y'})
+    {'a': True, 'b': True}
+    >>> form.validate({'parts': 'x_y', 'a': 'x', 'b': 'x'})
+    {'a': True, 'b': True}
+"""
+
+import math
+
+from xpath_validator import (
+    RETURNS_BOOL_AUTO,
+    XPathStr,
+    _bind,
+    _children,
+    _evaluate,
+    _variables,
+    compile,
+)
+from xpath_validator.xp_parse import BinOp, Call, Dot, If, Literal, Shared, Var
+
+
+def _facts(node, memo):
+    """(pure, uses_dot) for every node of a tree, kept in memo by id"""
+    pure, uses_dot = True, node.__class__ is Dot
+    if node.__class__ is Call:
+        pure = node.spec.pure
+    for child in _children(node):
+        child_pure, child_dot = _facts(child, memo)
+        pure = pure and child_pure
+        uses_dot = uses_dot or child_dot
+    memo[id(node)] = (pure, uses_dot)
+    return pure, uses_dot
+
+
+def _shareable(node):
+    return node.__class__ not in (Literal, Dot, Var)
+
+
+def _uses_dot(node):
+    return node.__class__ is Dot or any(_uses_dot(child) for child in _children(node))
+
+
+def _shared_in(node):
+    if node.__class__ is Shared:
+        yield node
+    for child in _children(node):
+        for shared in _shared_in(child):
+            yield shared
+
+
+def _same(a, b):
+    '''
+    whether a result did not change: of the same type and equal, nan
+    results included, -0.0 and 0.0 apart
+
+    >>> _same(True, 1.0), _same(0.0, -0.0), _same(float('nan'), float('nan'))
+    (False, False, True)
+    '''
+    if a.__class__ is not b.__class__:
+        return False
+    if a.__class__ is float:
+        if a != a:
+            return b != b
+        return a == b and math.copysign(1.0, a) == math.copysign(1.0, b)
+    return a == b
+
+
+class FormValidator:
+    def __init__(self, rules, registry=None):
+        """rules maps each field name to its expression"""
+        self.rules = dict(rules)
+        compiled = [(field, compile(expression, registry=registry)) for field, expression in sorted(rules.items())]
+        self.variables = frozenset().union(*[exp.variables for field, exp in compiled])
+
+        # subtrees are numbered before any rewriting: replacing children with
+        # Shared nodes changes the structural hash of their parents
+        facts, numbers, counts = {}, {}, []
+        for field, exp in compiled:
+            _facts(exp.tree, facts)
+            self._number(exp.tree, field, facts, numbers, counts)
+
+        self._shared = {}
+        self._rules = []
+        for field, exp in compiled:
+            tree = self._share(exp.tree, facts, counts)
+            self._rules.append((field, tree, exp._wraps))
+
+        # the names each rule and each shared subexpression reads, for
+        # sessions: "." reads the rule's own field
+        self._reads = {}
+        self._depends = {}
+        for field, tree, wraps in self._rules:
+            for name in _variables(tree) | {field}:
+                self._reads.setdefault(name, []).append(field)
+            for node in _shared_in(tree):
+                self._depends[node.key] = _variables(node) | ({field} if _uses_dot(node) else set())
+
+    @property
+    def shared(self):
+        """the subexpressions evaluated once per submission"""
+        return [self._shared[number] for number in sorted(self._shared)]
+
+    def _number(self, node, field, facts, numbers, counts):
+        pure, uses_dot = facts[id(node)]
+        if pure and _shareable(node):
+            # "." is a different value in the rule of each field
+            key = (node, field if uses_dot else None)
+            if key in numbers:
+                # the subtrees of a repeat are evaluated with it
+                facts[id(node)] = numbers[key]
+                counts[numbers[key]] += 1
+                return
+            facts[id(node)] = numbers[key] = len(counts)
+            counts.append(1)
+        else:
+            facts[id(node)] = None
+        for child in _children(node):
+            self._number(child, field, facts, numbers, counts)
+
+    def _share(self, node, facts, counts):
+        number = facts[id(node)]
+        if number is not None and counts[number] > 1:
+            if number not in self._shared:
+                self._shared[number] = Shared(("#", len(self._shared)), self._share_children(node, facts, counts))
+            return self._shared[number]
+        return self._share_children(node, facts, counts)
+
+    def _share_children(self, node, facts, counts):
+        cls = node.__class__
+        if cls is BinOp:
+            node.left = self._share(node.left, facts, counts)
+            node.right = self._share(node.right, facts, counts)
+        elif cls is Call:
+            node.args = tuple(self._share(a, facts, counts) for a in node.args)
+        elif cls is If:
+            node.test = self._share(node.test, facts, counts)
+            node.then = self._share(node.then, facts, counts)
+            node.orelse = self._share(node.orelse, facts, counts)
+        return node
+
+    def validate(self, values, context=None, returns_bool=RETURNS_BOOL_AUTO):
+        """returns the result of the rule of each field"""
+        return FormSession(self, values, context, returns_bool).results
+
+    def session(self, values, context=None, returns_bool=RETURNS_BOOL_AUTO):
+        """a FormSession started with values"""
+        return FormSession(self, values, context, returns_bool)
+
+
+class FormSession:
+    '''
+    keeps the values and results of one form being filled in
+
+    update() re-evaluates only the rules that read a changed field, through
+    "." or ${name}, and returns the results that changed
+
+    >>> form = FormValidator({'start': '. >= 0', 'end': '. > ${start}', 'name': 'string-length(.) > 0'})
+    >>> session = form.session({'start': 1, 'end': 5, 'name': ''})
+    >>> session.results
+    {'end': True, 'name': False, 'start': True}
+    >>> session.update({'start': 7})
+    {'end': False}
+    >>> session.update({'name': 'ana', 'end': 8})
+    {'end': True, 'name': True}
+    >>> session.update({'name': 'bia'})
+    {}
+
+    results of another type, or 0.0 turning into -0.0, are changes
+
+    >>> form = FormValidator({'a': 'choose(${x} > 0, true(), 1)', 'b': '0 * ${x}'})
+    >>> session = form.session({'x': 1, 'a': None, 'b': None}, returns_bool=False)
+    >>> session.update({'x': -1})
+    {'a': 1.0, 'b': -0.0}
+    '''
+
+    def __init__(self, form, values, context=None, returns_bool=RETURNS_BOOL_AUTO):
+        self.form = form
+        self.values = dict(values)
+        self.returns_bool = returns_bool
+        env = dict(context) if context else {}
+        env.update(values)
+        self._scope = {}
+        for name in form.variables:
+            self._scope[name] = _bind(env[name])
+        self.results = {}
+        for rule in form._rules:
+            self.results[rule[0]] = self._run(rule)
+
+    def _run(self, rule):
+        field, tree, wraps = rule
+        data_node = self.values.get(field)
+        if isinstance(data_node, str):
+            data_node = XPathStr(data_node)
+        result = _evaluate(tree, data_node, self._scope)
+        return bool(result) if self.returns_bool and wraps else result
+
+    def update(self, changes):
+        """sets the values of some fields, returns the results that changed"""
+        form = self.form
+        self.values.update(changes)
+        for name in changes:
+            if name in form.variables:
+                self._scope[name] = _bind(changes[name])
+        # shared values computed from the old values are forgotten
+        for key, names in form._depends.items():
+            if key in self._scope and not names.isdisjoint(changes):
+                del self._scope[key]
+        fields = set()
+        for name in changes:
+            fields.update(form._reads.get(name, ()))
+        changed = {}
+        for rule in form._rules:
+            if rule[0] in fields:
+                result = self._run(rule)
+                if not _same(result, self.results[rule[0]]):
+                    self.results[rule[0]] = changed[rule[0]] = result
+        return changed
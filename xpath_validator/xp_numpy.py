@@ -0,0 +1,178 @@
+"""
+    Vectorized evaluation over NumPy arrays
+
+    Expressions built only from arithmetic, comparisons, and/or and the
+    numeric functions run as whole-array operations with "." bound to the
+    array; anything else falls back to evaluating item by item.
+
+    >>> import numpy as np
+    >>> values = np.arange(10)
+    >>> evaluate_array('. >= ${min} and . <= ${max}', values, {'min': 3, 'max': 6})
+    array([False, False, False,  True,  True,  True,  True, False, False,
+           False])
+    >>> int(evaluate_array('(. mod 2) = 0', values).sum())
+    5
+    >>> evaluate_array('floor(. div 3) = 1', values).nonzero()[0]
+    array([3, 4, 5])
+
+    The results are the ones validate() would give for every item, so the
+    cases where the vectorized operations would differ go item by item
+
+    >>> vectorizable(compile('string-length(.) > 2').tree)
+    False
+    >>> evaluate_array('string-length(string(.)) > 2', np.array([5, 500]))
+    array([False,  True])
+    >>> evaluate_array('(10 div .) > 1', np.array([5, 0]))
+    Traceback (most recent call last):
+        ...
+    ZeroDivisionError: float division by zero
+"""
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+from xpath_validator import FUNCTIONS, CompiledExpression, compile
+from xpath_validator.xp_parse import BinOp, Call, Dot, If, Literal, Var
+
+
+class _Fallback(Exception):
+    pass
+
+
+def _float(x):
+    # numpy has no arithmetic on booleans, Python treats them as 0 and 1
+    return np.asarray(x, dtype=float)
+
+
+_ARITHMETIC = {
+    "+": lambda x, y: np.add(_float(x), _float(y)),
+    "-": lambda x, y: np.subtract(_float(x), _float(y)),
+    "*": lambda x, y: np.multiply(_float(x), _float(y)),
+    "<": lambda x, y: np.less(x, y),
+    ">": lambda x, y: np.greater(x, y),
+    "=": lambda x, y: np.equal(x, y),
+    "!=": lambda x, y: np.not_equal(x, y),
+    "<=": lambda x, y: np.less_equal(x, y),
+    ">=": lambda x, y: np.greater_equal(x, y),
+}
+
+
+def _finite(x):
+    # floor(), ceiling() and round() raise for nan and inf
+    x = _float(x)
+    if not np.all(np.isfinite(x)):
+        raise _Fallback()
+    return x
+
+
+def _nonzero(x):
+    # div and mod raise ZeroDivisionError
+    x = _float(x)
+    if np.any(np.equal(x, 0)):
+        raise _Fallback()
+    return x
+
+
+_FUNCTIONS = {
+    "true": (0, lambda: True),
+    "false": (0, lambda: False),
+    "boolean": (1, lambda x: _truth(x)),
+    "not": (1, lambda x: np.logical_not(_truth(x))),
+    "ceiling": (1, lambda x: np.ceil(_finite(x))),
+    "floor": (1, lambda x: np.floor(_finite(x))),
+    "round": (1, lambda x: np.round(_finite(x))),
+    "int": (1, lambda x: np.where(np.isfinite(_float(x)), np.trunc(_float(x)), np.nan)),
+    "number": (1, _float),
+}
+
+
+def _truth(x):
+    return np.not_equal(x, 0)
+
+
+def vectorizable(node):
+    '''
+    >>> vectorizable(compile('choose(. > 5, floor(.), ${x} mod 3) != 1').tree)
+    True
+    '''
+    cls = node.__class__
+    if cls is Dot or cls is Var:
+        return True
+    if cls is Literal:
+        return isinstance(node.value, (bool, float))
+    if cls is BinOp:
+        return (
+            (node.op in _ARITHMETIC or node.op in ("div", "mod", "and", "or")) and
+            vectorizable(node.left) and
+            vectorizable(node.right)
+        )
+    if cls is Call:
+        return (
+            node.name in _FUNCTIONS and
+            # not replaced in the registry the expression was compiled with
+            (node.spec is None or node.spec.function is FUNCTIONS[node.name]) and
+            _FUNCTIONS[node.name][0] == len(node.args) and
+            all(vectorizable(a) for a in node.args)
+        )
+    if cls is If:
+        return vectorizable(node.test) and vectorizable(node.then) and vectorizable(node.orelse)
+    return False
+
+
+def _vector(node, dot, scope):
+    cls = node.__class__
+    if cls is Dot:
+        return dot
+    if cls is Literal:
+        return node.value
+    if cls is Var:
+        value = scope[node.name]
+        if not isinstance(value, (bool, float)):
+            raise _Fallback()
+        return value
+    if cls is If:
+        return np.where(
+            _truth(_vector(node.test, dot, scope)),
+            _vector(node.then, dot, scope),
+            _vector(node.orelse, dot, scope),
+        )
+    if cls is Call:
+        return _FUNCTIONS[node.name][1](*[_vector(a, dot, scope) for a in node.args])
+    left = _vector(node.left, dot, scope)
+    right = _vector(node.right, dot, scope)
+    op = node.op
+    if op == "and":
+        return np.where(_truth(left), right, left)
+    if op == "or":
+        return np.where(_truth(left), left, right)
+    if op == "div":
+        return np.true_divide(_float(left), _nonzero(right))
+    if op == "mod":
+        return np.mod(_float(left), _nonzero(right))
+    return _ARITHMETIC[op](left, right)
+
+
+def evaluate_array(expression, values, context=None):
+    '''
+    returns a boolean mask with the result of the expression for each value
+
+    expression is a string or a CompiledExpression; integers and booleans in
+    values are evaluated as floats
+    '''
+    if np is None:
+        raise ImportError("evaluate_array() needs numpy")
+    if not isinstance(expression, CompiledExpression):
+        expression = compile(expression)
+    values = np.asarray(values)
+    scope = expression._scope(context)
+    if values.dtype.kind in "biuf" and vectorizable(expression.tree):
+        try:
+            with np.errstate(all="ignore"):
+                result = _vector(expression.tree, values.astype(float), scope)
+            return np.broadcast_to(_truth(result), values.shape).copy()
+        except _Fallback:
+            pass
+    results = expression.evaluate_many(values.ravel().tolist(), context)
+    return np.fromiter(map(bool, results), dtype=bool, count=values.size).reshape(values.shape)
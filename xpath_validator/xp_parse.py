@@ -1,21 +1,146 @@
 """
     Based on http://www.tinypy.org/ code
+
+    tokenize() and parse() keep all their state in per-call objects, so they
+    can run in many threads at once
+
+    >>> import sys, threading
+    >>> from xpath_validator.xp_tokenize import tokenize
+    >>> expressions = [
+    ...     "(. + %d) * %d >= ${v%d} and contains('%d', .) or not(%d)" % (i, i % 7, i, i, i)
+    ...     for i in range(1000)
+    ... ]
+    >>> expected = [parse(e, tokenize(e)) for e in expressions]
+    >>> results = {}
+    >>> def worker(n):
+    ...     results[n] = [parse(e, tokenize(e)) for e in expressions]
+    >>> interval = sys.getswitchinterval()
+    >>> sys.setswitchinterval(1e-6)
+    >>> threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+    >>> for t in threads:
+    ...     t.start()
+    >>> for t in threads:
+    ...     t.join()
+    >>> sys.setswitchinterval(interval)
+    >>> all(results[n] == expected for n in range(8))
+    True
 """
 
 from xpath_validator.xp_tokenize import clean, u_error
 
 
-def mktok(t, typ, val, itms=None):
-    '''
-    >>> t = {'from': (1, 8), 'type': 'symbol', 'val': '(', 'bp': 80, 'lbp': 70, 'led': call_led, 'nud': paren_nud}
-    >>> left = {'from': (1, 1), 'type': 'name', 'val': 'boolean', 'lbp': 0, 'nud': itself}
-    >>> mktok(t, "call", "$", [left]) == {'from': (1, 8), 'type': 'call', 'val': '$', 'items': [{'from': (1, 1), 'type': 'name', 'val': 'boolean', 'lbp': 0, 'nud': itself}]}
+class Node:
+    """
+    parse() returns a tree of these small nodes; they only hold what is
+    needed to evaluate the expression
+
+    >>> Node.__slots__, BinOp.__slots__
+    ((), ('op', 'left', 'right'))
+    >>> BinOp('+', Dot(), Literal(5.0)) == BinOp('+', Dot(), Literal(5.0))
     True
-    '''
-    r = {"from": t["from"], "type": typ, "val": val}
-    if itms is not None:
-        r["items"] = itms
-    return r
+    """
+
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for k, v in zip(self.__slots__, values):
+            setattr(self, k, v)
+
+    def _key(self):
+        return (self.__class__,) + tuple(getattr(self, k) for k in self.__slots__)
+
+    def __eq__(self, other):
+        return isinstance(other, Node) and self._key() == other._key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        return "%s(%s)" % (
+            self.__class__.__name__,
+            ", ".join(repr(getattr(self, k)) for k in self.__slots__),
+        )
+
+
+class Literal(Node):
+    """
+    literals of different types are different, even when their values are equal
+
+    >>> Literal(True) == Literal(1.0), Literal(1) == Literal(1.0)
+    (False, False)
+    """
+
+    __slots__ = ("value",)
+
+    def _key(self):
+        return (Literal, self.value.__class__, self.value)
+
+
+class Name(Node):
+    __slots__ = ("name",)
+
+
+class Dot(Node):
+    __slots__ = ()
+
+
+class Var(Node):
+    __slots__ = ("name",)
+
+
+class Call(Node):
+    """
+    name(args); spec is the FunctionSpec the name resolves to, set when the
+    expression is compiled and not part of the structure of the node
+
+    >>> Call('int', (Dot(),))
+    Call('int', (Dot(),))
+    """
+
+    __slots__ = ("name", "args", "spec")
+
+    def __init__(self, name, args, spec=None):
+        self.name = name
+        self.args = args
+        self.spec = spec
+
+    def _key(self):
+        return (Call, self.name, self.args)
+
+    def __repr__(self):
+        return "Call(%r, %r)" % (self.name, self.args)
+
+
+class BinOp(Node):
+    __slots__ = ("op", "left", "right")
+
+
+class If(Node):
+    """choose(test, then, orelse); not made by the parser itself"""
+
+    __slots__ = ("test", "then", "orelse")
+
+
+class Shared(Node):
+    """
+    a subtree evaluated at most once per scope, its value is kept in the
+    scope under key; not made by the parser itself
+    """
+
+    __slots__ = ("key", "node")
+
+
+class Chain(Node):
+    """
+    an "and" or "or" of operands that may run in any order, with how often
+    each one was evaluated and decided the result; not made by the parser
+    itself
+    """
+
+    __slots__ = ("op", "operands", "costs", "tried", "decided", "evaluations")
 
 
 def check(t, *vs):
@@ -28,121 +153,140 @@ def check(t, *vs):
     return False
 
 
-def tweak(k, v):
-    P.stack.append((k, dmap[k]))
+def tweak(P, k, v):
+    P.stack.append((k, P.dmap[k]))
     if v:
-        dmap[k] = omap[k]
+        P.dmap[k] = P.omap[k]
     else:
-        dmap[k] = {"lbp": 0, "nud": itself}
+        P.dmap[k] = {"lbp": 0}
 
 
-def restore():
+def restore(P):
     k, v = P.stack.pop()
-    dmap[k] = v
+    P.dmap[k] = v
 
 
 class PData:
+    """all the state of one parse() call, so parsers can run concurrently"""
+
     def __init__(self, s, tokens):
         self.s = s
         self.tokens = tokens
         self.pos = 0
         self.token = None
+        self.rule = None
         self.stack = []
+        self.omap = base_dmap
+        self.dmap = base_dmap.copy()
 
     def init(self):
-        global omap, dmap
-        omap = base_dmap.copy()
-        dmap = base_dmap.copy()
         self.advance()
 
     def advance(self, val=None):
         if not check(self.token, val):
-            error("expected " + val, self.token)
+            error(self, "expected " + val, self.token)
         if self.pos < len(self.tokens):
             t = self.tokens[self.pos]
             self.pos += 1
         else:
-            t = {"from": (0, 0), "type": "eof", "val": "eof"}
-        self.token = do(t)
+            t = EOF
+        self.token, self.rule = t, do(self, t)
         return t
 
 
-def error(ctx, t):
+EOF = {"from": (0, 0), "type": "eof", "val": "eof"}
+
+
+def error(P, ctx, t):
     u_error(ctx, P.s, t["from"])
 
 
-def nud(t):
-    if "nud" not in t:
-        error("no nud", t)
-    return t["nud"](t)
+def nud(P, t, r):
+    if "nud" not in r:
+        error(P, "no nud", t)
+    return r["nud"](P, t, r)
 
 
-def led(t, left):
-    if "led" not in t:
-        error("no led", t)
-    return t["led"](t, left)
+def led(P, t, r, left):
+    if "led" not in r:
+        error(P, "no led", t)
+    return r["led"](P, t, r, left)
 
 
-def get_lbp(t):
-    if "lbp" not in t:
-        error("no lbp", t)
-    return t["lbp"]
+def get_lbp(P, t, r):
+    if "lbp" not in r:
+        error(P, "no lbp", t)
+    return r["lbp"]
 
 
-def expression(rbp):
-    t = P.token
-    advance()
-    left = nud(t)
-    while rbp < get_lbp(P.token):
-        t = P.token
-        advance()
-        left = led(t, left)
+def expression(P, rbp):
+    t, r = P.token, P.rule
+    advance(P)
+    left = nud(P, t, r)
+    while rbp < get_lbp(P, P.token, P.rule):
+        t, r = P.token, P.rule
+        advance(P)
+        left = led(P, t, r, left)
     return left
 
 
-def infix_led(t, left):
-    t["items"] = [left, expression(t["bp"])]
-    return t
+def infix_led(P, t, r, left):
+    return BinOp(t["val"], left, expression(P, r["bp"]))
 
 
-def call_led(t, left):
-    r = mktok(t, "call", "$", [left])
+def call_led(P, t, r, left):
+    if not isinstance(left, Name):
+        error(P, "expected a function name", t)
+    args = []
     while not check(P.token, ")"):
-        tweak(",", 0)
-        r["items"].append(expression(0))
+        tweak(P, ",", 0)
+        args.append(expression(P, 0))
         if P.token["val"] == ",":
-            advance(",")
-        restore()
-    advance(")")
-    return r
+            advance(P, ",")
+        restore(P)
+    advance(P, ")")
+    return Call(left.name, tuple(args))
+
+
+def number_nud(P, t, r):
+    try:
+        return Literal(float(t["val"]))
+    except ValueError:
+        return Literal(t["val"])
+
+
+def string_nud(P, t, r):
+    return Literal(t["val"])
+
 
+def name_nud(P, t, r):
+    return Name(t["val"])
 
-def itself(t):
-    return t
 
+def variable_nud(P, t, r):
+    return Var(t["val"])
 
-def paren_nud(t):
-    tweak(",", 1)
-    r = expression(0)
-    restore()
-    advance(")")
-    return r
 
+def paren_nud(P, t, r):
+    tweak(P, ",", 1)
+    n = expression(P, 0)
+    restore(P)
+    advance(P, ")")
+    return n
 
-def advance(t=None):
+
+def advance(P, t=None):
     return P.advance(t)
 
 
-def vargs_nud(t):
-    t["type"] = "var"
-    t["val"] = "."
-    return t
+def vargs_nud(P, t, r):
+    return Dot()
 
 
 base_dmap = {
     "!=": {"bp": 40, "lbp": 40, "led": infix_led},
     "(": {"bp": 80, "lbp": 70, "led": call_led, "nud": paren_nud},
-    ")": {"lbp": 0, "nud": itself},
+    ")": {"lbp": 0},
     "+": {"bp": 50, "lbp": 50, "led": infix_led},
     ",": {"bp": 20, "lbp": 20},
     "-": {"bp": 50, "lbp": 50, "led": infix_led},
@@ -157,45 +301,87 @@ base_dmap = {
     "div": {"bp": 60, "lbp": 60, "led": infix_led},
     "*": {"bp": 60, "lbp": 60, "led": infix_led},
     "mod": {"bp": 60, "lbp": 60, "led": infix_led},
-    "eof": {"lbp": 0, "type": "eof", "val": "eof"},
-    "name": {"lbp": 0, "nud": itself},
-    "nl": {"lbp": 0, "nud": itself, "val": "nl"},
-    "number": {"lbp": 0, "nud": itself},
-    "string": {"lbp": 0, "nud": itself},
+    "eof": {"lbp": 0},
+    "name": {"lbp": 0, "nud": name_nud},
+    "number": {"lbp": 0, "nud": number_nud},
+    "string": {"lbp": 0, "nud": string_nud},
+    "variable": {"lbp": 0, "nud": variable_nud},
 }
 
 
-def gmap(t, v):
-    if v not in dmap:
-        error('unknown "%s"' % v, t)
-    return dmap[v]
+def gmap(P, t, v):
+    if v not in P.dmap:
+        error(P, 'unknown "%s"' % v, t)
+    return P.dmap[v]
 
 
-def do(t):
+def do(P, t):
     if t["type"] == "symbol":
-        r = gmap(t, t["val"])
-    else:
-        r = gmap(t, t["type"])
-    for k in r:
-        t[k] = r[k]
-    return t
+        return gmap(P, t, t["val"])
+    return gmap(P, t, t["type"])
 
 
-def do_module():
-    tok = P.token
-    items = []
-    while not check(P.token, "eof"):
-        items.append(expression(0))
-    if len(items) > 1:
-        return mktok(tok, "statements", ";", items)
-    return items.pop()
+def do_module(P):
+    n = expression(P, 0)
+    if not check(P.token, "eof"):
+        error(P, "expected the end of the expression", P.token)
+    return n
 
 
 def parse(s, tokens, wrap=0):
-    global P
+    '''
+    >>> from xpath_validator.xp_tokenize import tokenize
+    >>> parse("choose(. > 1, 'a', ${b})", tokenize("choose(. > 1, 'a', ${b})"))
+    Call('choose', (BinOp('>', Dot(), Literal(1.0)), Literal('a'), Var('b')))
+    '''
     s = clean(s)
     P = PData(s, tokens)
     P.init()
-    r = do_module()
-    P = None
-    return r
+    return do_module(P)
+
+
+def _unparse_value(value):
+    if value is True:
+        return "true()"
+    if value is False:
+        return "false()"
+    if isinstance(value, str):
+        quote = "'" if '"' in value else '"'
+        return quote + value + quote
+    if isinstance(value, float):
+        if value != value or value in (float("inf"), float("-inf")):
+            return "number('%r')" % value
+        if value.is_integer():
+            return "%d" % value
+    return repr(value)
+
+
+def unparse(node):
+    '''
+    the expression text of a tree, to show what compile() made of it
+
+    >>> unparse(If(BinOp('>', Dot(), Literal(1.0)), Literal('a'), Var('b')))
+    'choose((. > 1), "a", ${b})'
+    '''
+    cls = node.__class__
+    if cls is Literal:
+        return _unparse_value(node.value)
+    if cls is Name:
+        return node.name
+    if cls is Dot:
+        return "."
+    if cls is Var:
+        return "${%s}" % node.name
+    if cls is Call:
+        return "%s(%s)" % (node.name, ", ".join(unparse(a) for a in node.args))
+    if cls is If:
+        test = node.test
+        if test.__class__ is Call and test.name == "choose":
+            # the instrumented test of a choose()
+            test = test.args[0]
+        return "choose(%s, %s, %s)" % (unparse(test), unparse(node.then), unparse(node.orelse))
+    if cls is Shared:
+        return unparse(node.node)
+    if cls is Chain:
+        return "(%s)" % (" %s " % node.op).join(unparse(o) for o in node.operands)
+    return "(%s %s %s)" % (unparse(node.left), node.op, unparse(node.right))
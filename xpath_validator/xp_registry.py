@@ -0,0 +1,200 @@
+"""
+    Function registries
+
+    A registry maps function names to the function and what is known about
+    it: how many arguments it takes, whether it is pure (same arguments, same
+    result, no side effects) and an estimated cost relative to a comparison.
+    Only pure functions are computed when an expression is compiled or shared
+    between rules, and functions are impure unless registered with pure=True.
+    Expressions resolve their functions once, when they are compiled.
+
+    Registries are chained: names not registered in one are looked up in its
+    parent, so each tenant can extend the built-in functions without touching
+    the global registry.
+
+    >>> from xpath_validator import FUNCTION_REGISTRY, compile
+    >>> tenant = FunctionRegistry(parent=FUNCTION_REGISTRY)
+    >>> tenant.register('is_even', lambda x: x % 2 == 0, 1)
+    >>> compile('is-even(.) and . > 2', registry=tenant).evaluate(4)
+    True
+    >>> compile('is-even(.)')
+    Traceback (most recent call last):
+        ...
+    KeyError: 'unknown function is_even'
+    >>> compile('is-even(., 2)', registry=tenant)
+    Traceback (most recent call last):
+        ...
+    TypeError: is_even() takes 1 argument (2 given)
+    >>> tenant.get('string_length').arity
+    1
+
+    functions are impure unless they are registered with pure=True, so
+    their calls are left for evaluation
+
+    >>> from itertools import count
+    >>> ids = count(1)
+    >>> tenant.register('next-id', lambda: next(ids), 0)
+    >>> exp = compile('next-id() > 0 and next-id()', registry=tenant)
+    >>> str(exp), exp.evaluate(None, returns_bool=False), exp.evaluate(None, returns_bool=False)
+    ('((next_id() > 0) and next_id())', 2, 4)
+"""
+
+import hashlib
+import threading
+
+
+class FunctionSpec:
+    """
+    a registered function
+
+    arity is the number of arguments, a (min, max) pair or None when it is
+    not checked
+    """
+
+    __slots__ = ("name", "function", "arity", "pure", "cost")
+
+    def __init__(self, name, function, arity, pure=False, cost=1):
+        self.name = name
+        self.function = function
+        self.arity = arity
+        self.pure = pure
+        self.cost = cost
+
+    def __repr__(self):
+        return "FunctionSpec(%r, arity=%r, pure=%r, cost=%r)" % (self.name, self.arity, self.pure, self.cost)
+
+    def check_arity(self, count):
+        '''
+        >>> FunctionSpec('round', round, (1, 2)).check_arity(3)
+        Traceback (most recent call last):
+            ...
+        TypeError: round() takes from 1 to 2 arguments (3 given)
+        '''
+        arity = self.arity
+        if arity is None:
+            return
+        if isinstance(arity, tuple):
+            if arity[0] <= count <= arity[1]:
+                return
+            expected = "from %d to %d arguments" % arity
+        else:
+            if count == arity:
+                return
+            expected = "%d argument%s" % (arity, "" if arity == 1 else "s")
+        raise TypeError("%s() takes %s (%d given)" % (self.name, expected, count))
+
+
+class FunctionRegistry:
+    '''
+    >>> registry = FunctionRegistry()
+    >>> registry.register('double', lambda x: x * 2, 1, pure=True, cost=2)
+    >>> registry.get('double')
+    FunctionSpec('double', arity=1, pure=True, cost=2)
+    >>> registry.version
+    1
+    '''
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self._specs = {}
+        self._version = 0
+        self._fingerprint = None
+        self._lock = threading.Lock()
+
+    @property
+    def version(self):
+        """changes whenever a function is registered here or in a parent"""
+        if self.parent is None:
+            return self._version
+        return self._version + self.parent.version
+
+    def register(self, name, function, arity, pure=False, cost=1):
+        """
+        adds or replaces a function; hyphens in name are read as
+        underscores, like in expressions
+
+        expressions compiled before keep the function they were compiled with
+        """
+        name = name.replace("-", "_")
+        with self._lock:
+            self._specs[name] = FunctionSpec(name, function, arity, pure, cost)
+            self._version += 1
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def get(self, name):
+        spec = self._specs.get(name)
+        if spec is None and self.parent is not None:
+            return self.parent.get(name)
+        return spec
+
+    def resolve(self, name, count):
+        """the spec of a function called with count arguments"""
+        spec = self.get(name)
+        if spec is None:
+            raise KeyError("unknown function %s" % name)
+        spec.check_arity(count)
+        return spec
+
+    def specs(self):
+        """every function this registry resolves, by name"""
+        specs = self.parent.specs() if self.parent is not None else {}
+        specs.update(self._specs)
+        return specs
+
+    def fingerprint(self):
+        '''
+        a digest of the name, arity, purity and code of every function; two
+        processes registering the same functions get the same fingerprint,
+        unlike version, which only counts the changes
+
+        >>> a, b = FunctionRegistry(), FunctionRegistry()
+        >>> a.register('rate', lambda: 0.1, 0, pure=True)
+        >>> b.register('rate', lambda: 0.5, 0, pure=True)
+        >>> a.version == b.version, a.fingerprint() == b.fingerprint()
+        (True, False)
+        '''
+        version = self.version
+        cached = self._fingerprint
+        if cached is None or cached[0] != version:
+            cached = self._fingerprint = (version, _fingerprint(self.specs()))
+        return cached[1]
+
+
+def _fingerprint(specs):
+    h = hashlib.blake2b(digest_size=16)
+    for name, spec in sorted(specs.items()):
+        h.update(repr((name, spec.arity, spec.pure)).encode("utf-8"))
+        _hash_function(spec.function, h)
+    return h.digest()
+
+
+def _hash_function(function, h):
+    """
+    hashes what a function is, the same in every process; a function
+    without code (a builtin) is known by its name
+    """
+    name = "%s.%s" % (getattr(function, "__module__", None), getattr(function, "__qualname__", repr(function)))
+    h.update(name.encode("utf-8"))
+    code = getattr(function, "__code__", None)
+    if code is not None:
+        _hash_code(code, h)
+        h.update(_stable_repr(getattr(function, "__defaults__", None)).encode("utf-8"))
+
+
+def _hash_code(code, h):
+    h.update(code.co_code)
+    h.update(repr(code.co_names).encode("utf-8"))
+    for const in code.co_consts:
+        if hasattr(const, "co_code"):
+            _hash_code(const, h)
+        else:
+            h.update(_stable_repr(const).encode("utf-8"))
+
+
+def _stable_repr(value):
+    # the order of a frozenset depends on the hash seed of the process
+    if isinstance(value, frozenset):
+        return "frozenset(%r)" % sorted(_stable_repr(v) for v in value)
+    return repr(value)
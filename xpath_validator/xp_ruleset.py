@@ -0,0 +1,259 @@
+"""
+    Matching one value against many rules
+
+    RuleSet finds every rule a value matches.  Rules shaped like
+    ". >= A and . <= B", ". = 'X'" or "starts-with(., 'pfx')", or an "or" of
+    rules of one of these shapes, are looked up in indexes (an interval
+    tree, a dict and a trie) instead of being evaluated, so a lookup costs
+    about the number of rules that match.  Any other rule is evaluated.
+
+    >>> rules = RuleSet({
+    ...     'teen': '. >= 13 and . < 20',
+    ...     'adult': '. >= ${adult}',
+    ...     'answer': '. = 42',
+    ...     'br': "starts-with(., 'br-')",
+    ...     'south': "starts-with(., 'br-rs-') or starts-with(., 'br-sc-')",
+    ...     'even': '(. mod 2) = 0',
+    ... }, static_context={'adult': 18})
+    >>> rules.fallback
+    ['even']
+    >>> rules.match(18)
+    ['teen', 'adult', 'even']
+    >>> rules.match(42)
+    ['adult', 'answer', 'even']
+    >>> rules.match('br-sc-florianopolis')
+    ['br', 'south']
+    >>> rules.match(float('inf')), rules.match(float('-inf'))
+    (['adult'], [])
+    >>> RuleSet({'low': '. <= 5', 'finite': '. < 1e308 and . > -1e308'}).match(float('-inf'))
+    ['low']
+
+    A rule that fails for a value, like comparing a string with a number,
+    does not match it
+
+    >>> rules.match('x')
+    []
+"""
+
+from xpath_validator import FUNCTIONS, XPathStr, compile
+from xpath_validator.xp_parse import BinOp, Call, Dot, Literal
+
+_FLIP = {"<": ">", ">": "<", "<=": ">=", ">=": "<=", "=": "="}
+
+_INFINITY = float("inf")
+
+
+def _comparison(node):
+    """(op, value) of a comparison between "." and a literal, or None"""
+    if node.__class__ is not BinOp or node.op not in _FLIP:
+        return None
+    left, right = node.left, node.right
+    if left.__class__ is Dot and right.__class__ is Literal:
+        return node.op, right.value
+    if right.__class__ is Dot and left.__class__ is Literal:
+        return _FLIP[node.op], left.value
+    return None
+
+
+def _conjuncts(node):
+    if node.__class__ is BinOp and node.op == "and":
+        return _conjuncts(node.left) + _conjuncts(node.right)
+    return [node]
+
+
+def _interval(node):
+    """
+    (lo, lo_closed, hi, hi_closed) of an "and" of numeric comparisons, or
+    None; a side with no bound is closed at infinity, which . >= 5 matches
+
+    >>> _interval(compile('. >= 5').tree)
+    (5.0, True, inf, True)
+    """
+    lo, lo_closed, hi, hi_closed = -_INFINITY, True, _INFINITY, True
+    for conjunct in _conjuncts(node):
+        comparison = _comparison(conjunct)
+        if comparison is None:
+            return None
+        op, value = comparison
+        if value.__class__ is not float or value != value:
+            return None
+        if op in (">", ">=", "=") and (value > lo or (value == lo and op == ">")):
+            lo, lo_closed = value, op != ">"
+        if op in ("<", "<=", "=") and (value < hi or (value == hi and op == "<")):
+            hi, hi_closed = value, op != "<"
+    return lo, lo_closed, hi, hi_closed
+
+
+def _atom(node):
+    """(kind, key) of a rule shape that has an index, or None"""
+    comparison = _comparison(node)
+    if comparison is not None and comparison[0] == "=":
+        value = comparison[1]
+        if value == value:
+            return "eq", value
+    if (
+        node.__class__ is Call and
+        node.spec.function is FUNCTIONS["starts_with"] and
+        node.args[0].__class__ is Dot and
+        node.args[1].__class__ is Literal and
+        isinstance(node.args[1].value, str)
+    ):
+        return "prefix", node.args[1].value
+    interval = _interval(node)
+    if interval is not None:
+        return "range", interval
+    return None
+
+
+def _atoms(node):
+    '''
+    the indexed parts of a rule that matches when any of them does
+
+    the parts must be of one kind: "or" evaluates them in order, and a range
+    fails for strings where a prefix fails for numbers
+
+    >>> _atoms(compile(". = 'a' or . = 'b'").tree)
+    [('eq', 'a'), ('eq', 'b')]
+    >>> _atoms(compile(". > 5 or . = 'b'").tree) is None
+    True
+    '''
+    if node.__class__ is BinOp and node.op == "or":
+        left, right = _atoms(node.left), _atoms(node.right)
+        if left is None or right is None or left[0][0] != right[0][0]:
+            return None
+        return left + right
+    atom = _atom(node)
+    if atom is None:
+        return None
+    return [atom]
+
+
+def _contains(interval, x):
+    lo, lo_closed, hi, hi_closed, index = interval
+    return (lo < x or (lo_closed and lo == x)) and (x < hi or (hi_closed and x == hi))
+
+
+class _IntervalTree:
+    '''
+    centered interval tree of (lo, lo_closed, hi, hi_closed, index)
+
+    >>> tree = _IntervalTree.build([(0, True, 10, False, 0), (5, False, 20, True, 1), (30, True, 40, True, 2)])
+    >>> sorted(tree.stab(5, [])), sorted(tree.stab(10, [])), tree.stab(25, [])
+    ([0], [1], [])
+    '''
+
+    __slots__ = ("center", "by_lo", "by_hi", "left", "right")
+
+    @classmethod
+    def build(cls, intervals):
+        if not intervals:
+            return None
+        points = sorted(p for interval in intervals for p in (interval[0], interval[2]))
+        center = points[len(points) // 2]
+        left, here, right = [], [], []
+        for interval in intervals:
+            if interval[2] < center:
+                left.append(interval)
+            elif interval[0] > center:
+                right.append(interval)
+            else:
+                here.append(interval)
+        node = cls()
+        node.center = center
+        node.by_lo = sorted(here, key=lambda interval: interval[0])
+        node.by_hi = sorted(here, key=lambda interval: -interval[2])
+        node.left = cls.build(left)
+        node.right = cls.build(right)
+        return node
+
+    def stab(self, x, out):
+        """appends the index of every interval containing x to out"""
+        node = self
+        while node is not None:
+            if x < node.center:
+                for interval in node.by_lo:
+                    if interval[0] > x:
+                        break
+                    if _contains(interval, x):
+                        out.append(interval[4])
+                node = node.left
+            elif x > node.center:
+                for interval in node.by_hi:
+                    if interval[2] < x:
+                        break
+                    if _contains(interval, x):
+                        out.append(interval[4])
+                node = node.right
+            else:
+                for interval in node.by_lo:
+                    if _contains(interval, x):
+                        out.append(interval[4])
+                break
+        return out
+
+
+class RuleSet:
+    def __init__(self, rules, static_context=None, registry=None):
+        """rules maps names to expressions, in the order matches are returned"""
+        self.names = []
+        self._compiled = []
+        self._fallback = []
+        self._equal = {}
+        self._prefixes = {}
+        intervals = []
+        for index, (name, expression) in enumerate(rules.items()):
+            exp = compile(expression, registry=registry, static_context=static_context)
+            self.names.append(name)
+            self._compiled.append(exp)
+            atoms = _atoms(exp.tree) if not exp.variables else None
+            if atoms is None:
+                self._fallback.append(index)
+                continue
+            for kind, key in atoms:
+                if kind == "eq":
+                    self._equal.setdefault(key, []).append(index)
+                elif kind == "prefix":
+                    node = self._prefixes
+                    for char in key:
+                        node = node.setdefault(char, {})
+                    node.setdefault(None, []).append(index)
+                else:
+                    lo, lo_closed, hi, hi_closed = key
+                    # an empty range never matches
+                    if lo < hi or (lo == hi and lo_closed and hi_closed):
+                        intervals.append(key + (index,))
+        self._intervals = _IntervalTree.build(intervals)
+
+    @property
+    def fallback(self):
+        """the names of the rules that are evaluated for every value"""
+        return [self.names[index] for index in self._fallback]
+
+    def match(self, value, context=None):
+        """the names of the rules value matches"""
+        if isinstance(value, str):
+            value = XPathStr(value)
+        found = []
+        try:
+            found.extend(self._equal.get(value, ()))
+        except TypeError:
+            pass  # unhashable, equal to no literal
+        if isinstance(value, str):
+            node = self._prefixes
+            found.extend(node.get(None, ()))
+            for char in value:
+                node = node.get(char)
+                if node is None:
+                    break
+                found.extend(node.get(None, ()))
+        elif isinstance(value, (int, float)) and value == value and self._intervals is not None:
+            self._intervals.stab(value, found)
+        for index in self._fallback:
+            try:
+                matched = self._compiled[index].evaluate(value, context)
+            except Exception:
+                matched = False
+            if matched:
+                found.append(index)
+        # an "or" of several keys can match more than once
+        return [self.names[index] for index in sorted(set(found))]
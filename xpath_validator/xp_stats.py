@@ -0,0 +1,143 @@
+"""
+    Opt-in instrumentation
+
+    enable_instrumentation() returns the Instrumentation that validate()
+    and compiled expressions report to: time per stage (tokenize, parse,
+    link, prepare, evaluate), calls and time per function, and the
+    expressions slower than a threshold, which are also logged on the
+    "xpath_validator" logger.  When it is off, the hot paths only test one
+    global.
+
+    >>> from xpath_validator import enable_instrumentation, disable_instrumentation, validate, validate_many
+    >>> stats = enable_instrumentation(slow_threshold=0)
+    >>> validate("int(format-date-time(., '%Y')) = 2019", '2019-05-14')
+    True
+    >>> validate("int(format-date-time(., '%Y')) = 2019", '2020-05-14')
+    False
+    >>> disable_instrumentation()
+    >>> snapshot = stats.snapshot()
+    >>> snapshot['stages']['parse']['count'], snapshot['stages']['evaluate']['count']
+    (1, 2)
+    >>> snapshot['functions']['format_date_time']['count']
+    2
+    >>> [s['expression'] for s in snapshot['slow']]
+    ["int(format-date-time(., '%Y')) = 2019", "int(format-date-time(., '%Y')) = 2019"]
+    >>> print(stats.prometheus().splitlines()[2])
+    xpath_validator_stage_calls_total{stage="evaluate"} 2
+
+    validate_many() reports every item, and choose() is counted like the
+    other functions
+
+    >>> stats = enable_instrumentation(slow_threshold=0)
+    >>> sum(validate_many('choose(. > 50, . < 90, . < 10) and . > 1', range(100)))
+    47
+    >>> disable_instrumentation()
+    >>> snapshot = stats.snapshot()
+    >>> snapshot['stages']['evaluate']['count'], snapshot['slow_count'], snapshot['functions']['choose']['count']
+    (100, 100, 100)
+"""
+
+import logging
+import threading
+
+from collections import deque
+
+from xpath_validator.xp_registry import FunctionSpec
+
+logger = logging.getLogger("xpath_validator")
+
+STAGES = ("tokenize", "parse", "link", "prepare", "evaluate")
+
+
+class Instrumentation:
+    def __init__(self, slow_threshold=None, slow_log_size=100):
+        """slow_threshold is in seconds, None keeps no slow-expression log"""
+        self.slow_threshold = slow_threshold
+        self._lock = threading.Lock()
+        self._slow_log_size = slow_log_size
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._stages = dict((stage, [0, 0.0]) for stage in STAGES)
+            self._functions = {}
+            self._slow = deque(maxlen=self._slow_log_size)
+            self._slow_count = 0
+
+    def stage(self, name, seconds):
+        with self._lock:
+            counter = self._stages[name]
+            counter[0] += 1
+            counter[1] += seconds
+
+    def function(self, name, seconds):
+        with self._lock:
+            counter = self._functions.get(name)
+            if counter is None:
+                counter = self._functions[name] = [0, 0.0]
+            counter[0] += 1
+            counter[1] += seconds
+
+    def evaluated(self, expression, seconds):
+        """records one evaluation of expression, prepare and evaluate included"""
+        if self.slow_threshold is not None and seconds >= self.slow_threshold:
+            with self._lock:
+                self._slow.append((expression, seconds))
+                self._slow_count += 1
+            logger.warning("slow expression (%.6fs): %s", seconds, expression)
+
+    def wrap(self, spec, clock):
+        """a spec whose function reports its calls"""
+        function, name, record = spec.function, spec.name, self.function
+
+        def timed(*args):
+            start = clock()
+            try:
+                return function(*args)
+            finally:
+                record(name, clock() - start)
+
+        return FunctionSpec(spec.name, timed, spec.arity, spec.pure, spec.cost)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "stages": dict(
+                    (name, {"count": count, "seconds": seconds}) for name, (count, seconds) in self._stages.items()
+                ),
+                "functions": dict(
+                    (name, {"count": count, "seconds": seconds}) for name, (count, seconds) in self._functions.items()
+                ),
+                "slow": [{"expression": e, "seconds": s} for e, s in self._slow],
+                "slow_count": self._slow_count,
+                "slow_threshold": self.slow_threshold,
+            }
+
+    def prometheus(self):
+        """the snapshot in the Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        lines = []
+
+        def metric(name, help, label, values):
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s counter" % name)
+            for key, value in sorted(values.items()):
+                lines.append('%s{%s="%s"} %r' % (name, label, _escape(key), value))
+
+        stages, functions = snapshot["stages"], snapshot["functions"]
+        metric("xpath_validator_stage_calls_total", "Runs of each stage.", "stage",
+               dict((k, v["count"]) for k, v in stages.items()))
+        metric("xpath_validator_stage_seconds_total", "Seconds spent in each stage.", "stage",
+               dict((k, v["seconds"]) for k, v in stages.items()))
+        metric("xpath_validator_function_calls_total", "Calls of each function.", "function",
+               dict((k, v["count"]) for k, v in functions.items()))
+        metric("xpath_validator_function_seconds_total", "Seconds spent in each function.", "function",
+               dict((k, v["seconds"]) for k, v in functions.items()))
+        lines.append("# HELP xpath_validator_slow_expressions_total Evaluations over the slow threshold.")
+        lines.append("# TYPE xpath_validator_slow_expressions_total counter")
+        lines.append("xpath_validator_slow_expressions_total %d" % snapshot["slow_count"])
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
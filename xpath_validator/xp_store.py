@@ -0,0 +1,264 @@
+"""
+    Compiled expressions saved to disk
+
+    A store file keeps the compiled trees of a rule catalog so worker
+    processes skip tokenizing, parsing and folding at startup.  The file is
+    mapped with mmap and each expression is decoded the first time it is
+    asked for.
+
+    A store is stale, and is not used, when it was written by another
+    library version, Python version (trees are kept in marshal format) or
+    with other functions (see FunctionRegistry.fingerprint).  open_store() rebuilds stale stores and
+    stores of another catalog.
+
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'rules.xpc')
+    >>> catalog = ['. >= ${min} and . <= 10 * 10', "starts-with(., 'br-')"]
+    >>> store = open_store(path, catalog)
+    >>> exp = store.compile('. >= ${min} and . <= 10 * 10')
+    >>> str(exp), exp.evaluate(50, {'min': 10})
+    ('((. >= ${min}) and (. <= 100))', True)
+    >>> store.loaded
+    1
+    >>> store.close()
+
+    the second worker finds the file up to date
+
+    >>> with open_store(path, catalog) as store:
+    ...     store.stale, len(store)
+    (False, 2)
+    >>> from xpath_validator import FUNCTION_REGISTRY
+    >>> from xpath_validator.xp_registry import FunctionRegistry
+    >>> tenant = FunctionRegistry(parent=FUNCTION_REGISTRY)
+    >>> with RuleStore(path, tenant) as store:
+    ...     store.stale
+    False
+    >>> tenant.register('is_even', lambda x: x % 2 == 0, 1)
+    >>> with RuleStore(path, tenant) as store:
+    ...     store.stale
+    True
+
+    a store written by a process whose function had other code is stale,
+    even though both registries have the same version
+
+    >>> old, new = FunctionRegistry(parent=FUNCTION_REGISTRY), FunctionRegistry(parent=FUNCTION_REGISTRY)
+    >>> old.register('rate', lambda: 0.1, 0, pure=True)
+    >>> new.register('rate', lambda: 0.5, 0, pure=True)
+    >>> write_store(path, ['. * rate() > 1'], old)
+    >>> with RuleStore(path, new) as store:
+    ...     store.stale, str(store.compile('. * rate() > 1'))
+    (True, '((. * 0.5) > 1)')
+"""
+
+import hashlib
+import marshal
+import mmap
+import os
+import struct
+import sys
+
+from xpath_validator import FUNCTION_REGISTRY, CompiledExpression, XPathStr, __version__, compile
+from xpath_validator.xp_parse import BinOp, Call, Dot, If, Literal, Var
+
+MAGIC = b"XPVC"
+FORMAT_VERSION = 2
+
+# magic, format version, library version, Python version, registry
+# fingerprint, catalog digest, number of expressions
+_HEADER = struct.Struct("<4sH16s8s16s16sI")
+# expression digest, record offset, record length
+_ENTRY = struct.Struct("<16sQI")
+
+_PYTHON = ("%d.%d/%d" % (sys.version_info[0], sys.version_info[1], marshal.version)).encode("ascii")
+
+
+def _digest(text):
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+def _catalog_digest(expressions):
+    h = hashlib.blake2b(digest_size=16)
+    for expression in sorted(set(expressions)):
+        h.update(_digest(expression))
+    return h.digest()
+
+
+class _Unstorable(Exception):
+    pass
+
+
+def _encode(node):
+    cls = node.__class__
+    if cls is Literal:
+        value = node.value
+        if value.__class__ is XPathStr:
+            return ("x", str(value))
+        if value is None or value.__class__ in (bool, int, float, str):
+            return ("l", value)
+        raise _Unstorable()
+    if cls is Dot:
+        return ("d",)
+    if cls is Var:
+        return ("v", node.name)
+    if cls is Call:
+        return ("c", node.name) + tuple(_encode(a) for a in node.args)
+    if cls is BinOp:
+        return ("b", node.op, _encode(node.left), _encode(node.right))
+    if cls is If:
+        return ("i", _encode(node.test), _encode(node.then), _encode(node.orelse))
+    raise _Unstorable()
+
+
+def _decode(data, resolve):
+    tag = data[0]
+    if tag == "l":
+        return Literal(data[1])
+    if tag == "x":
+        return Literal(XPathStr(data[1]))
+    if tag == "d":
+        return Dot()
+    if tag == "v":
+        return Var(data[1])
+    if tag == "c":
+        args = tuple(_decode(a, resolve) for a in data[2:])
+        return Call(data[1], args, resolve(data[1], len(args)))
+    if tag == "b":
+        return BinOp(data[1], _decode(data[2], resolve), _decode(data[3], resolve))
+    return If(_decode(data[1], resolve), _decode(data[2], resolve), _decode(data[3], resolve))
+
+
+def write_store(path, expressions, registry=None):
+    '''
+    compiles expressions and writes them to path, replacing it atomically;
+    expressions that fail to compile are left out and compiled, and fail,
+    when they are used
+    '''
+    if registry is None:
+        registry = FUNCTION_REGISTRY
+    expressions = sorted(set(expressions))
+    records = []
+    for expression in expressions:
+        try:
+            exp = compile(expression, registry=registry)
+            record = (expression, tuple(sorted(exp.variables)), _encode(exp.tree))
+            records.append((_digest(expression), marshal.dumps(record)))
+        except Exception:
+            continue
+    records.sort()
+    header = _HEADER.pack(
+        MAGIC,
+        FORMAT_VERSION,
+        __version__.encode("ascii"),
+        _PYTHON,
+        registry.fingerprint(),
+        _catalog_digest(expressions),
+        len(records),
+    )
+    offset = _HEADER.size + _ENTRY.size * len(records)
+    index = []
+    for digest, record in records:
+        index.append(_ENTRY.pack(digest, offset, len(record)))
+        offset += len(record)
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(header)
+        f.writelines(index)
+        f.writelines(record for digest, record in records)
+    os.replace(tmp, path)
+
+
+class RuleStore:
+    """a store file opened for reading"""
+
+    def __init__(self, path, registry=None):
+        if registry is None:
+            registry = FUNCTION_REGISTRY
+        self.path = path
+        self.registry = registry
+        self._compiled = {}
+        self._specs = {}
+        self.loaded = 0
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, format_version, library, python, functions, catalog, count = _HEADER.unpack_from(self._map, 0)
+        self.catalog = catalog
+        self._count = count
+        self.stale = (
+            magic != MAGIC or
+            format_version != FORMAT_VERSION or
+            library.rstrip(b"\0") != __version__.encode("ascii") or
+            python.rstrip(b"\0") != _PYTHON or
+            functions != registry.fingerprint()
+        )
+
+    def __len__(self):
+        return self._count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._map.close()
+
+    def _resolve(self, name, count):
+        key = (name, count)
+        spec = self._specs.get(key)
+        if spec is None:
+            spec = self._specs[key] = self.registry.resolve(name, count)
+        return spec
+
+    def _find(self, expression):
+        """(tree, variables) of expression, or None"""
+        digest = _digest(expression)
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry_digest, offset, length = _ENTRY.unpack_from(self._map, _HEADER.size + mid * _ENTRY.size)
+            if entry_digest < digest:
+                lo = mid + 1
+            elif entry_digest > digest:
+                hi = mid
+            else:
+                text, variables, data = marshal.loads(self._map[offset:offset + length])
+                if text != expression:
+                    return None
+                return _decode(data, self._resolve), variables
+        return None
+
+    def compile(self, expression, backend="interpreter"):
+        """the stored compiled expression, or a new one when it is not stored"""
+        key = (expression, backend)
+        compiled = self._compiled.get(key)
+        if compiled is None:
+            found = None
+            if not self.stale:
+                try:
+                    found = self._find(expression)
+                except (KeyError, TypeError):
+                    found = None  # a function missing from the registry
+            if found is None:
+                compiled = compile(expression, backend=backend, registry=self.registry)
+            else:
+                tree, variables = found
+                compiled = CompiledExpression._from_tree(expression, tree, backend, self.registry, variables)
+                self.loaded += 1
+            self._compiled[key] = compiled
+        return compiled
+
+
+def open_store(path, expressions, registry=None):
+    """opens the store of a catalog of expressions, writing it when it is missing or stale"""
+    expressions = list(expressions)
+    try:
+        store = RuleStore(path, registry)
+    except (OSError, ValueError, struct.error):
+        store = None
+    if store is not None:
+        if not store.stale and store.catalog == _catalog_digest(expressions):
+            return store
+        store.close()
+    write_store(path, expressions, registry)
+    return RuleStore(path, registry)
@@ -0,0 +1,62 @@
+"""
+    Tiered execution of the expressions cached by validate()
+
+    Expressions start on the tree interpreter, which costs nothing to set
+    up, and are compiled to Python code by the "python" backend once they
+    have run threshold times.
+
+    >>> from xpath_validator import EXPRESSION_CACHE, TIERING, _cached_compile, validate
+    >>> EXPRESSION_CACHE.clear()
+    >>> threshold = TIERING.threshold
+    >>> TIERING.threshold = 3
+    >>> [validate('. > 5', n) for n in (4, 6, 8)]
+    [False, True, True]
+    >>> exp = _cached_compile('. > 5')
+    >>> exp.backend, exp.runs
+    ('python', 3)
+    >>> TIERING.stats()['threshold'], TIERING.stats()['promotions'] >= 1
+    (3, True)
+
+    a batch going over the threshold promotes its expression once and runs
+    the generated code for the rest of the items
+
+    >>> from xpath_validator import validate_many
+    >>> promotions = TIERING.promotions
+    >>> sum(validate_many('. > 5 and . < 100000', range(50)))
+    44
+    >>> TIERING.promotions - promotions, _cached_compile('. > 5 and . < 100000').backend
+    (1, 'python')
+
+    operators replaced in ENV keep working after the promotion
+
+    >>> from xpath_validator import ENV
+    >>> equal = ENV['=']
+    >>> ENV['='] = lambda x, y: x.lower() == y.lower()
+    >>> [validate(". = 'ABC'", 'abc') for n in range(5)]
+    [True, True, True, True, True]
+    >>> ENV['='] = equal
+    >>> TIERING.threshold = threshold
+"""
+
+import threading
+
+
+class TierPolicy:
+    '''
+    >>> TierPolicy(threshold=0).enabled
+    False
+    '''
+
+    def __init__(self, threshold=1000):
+        """threshold is the number of runs before promotion, 0 or None turns promotion off"""
+        self.threshold = threshold
+        self.promotions = 0
+        # held while an expression is promoted, so it is promoted once
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.threshold)
+
+    def stats(self):
+        return {"threshold": self.threshold, "promotions": self.promotions}